@@ -23,9 +23,12 @@ vertices = []
 AST decision functions.
 """
 
+# try statements are ast.TryExcept on Python 2 and ast.Try on Python 3
+_TRY_STATEMENT_TYPE = ast.TryExcept if hasattr(ast, "TryExcept") else ast.Try
+
 
 def ast_is_try(ast_obj):
-    return type(ast_obj) is ast.TryExcept
+    return type(ast_obj) is _TRY_STATEMENT_TYPE
 
 
 def ast_is_assign(ast_obj):
@@ -76,93 +79,221 @@ def ast_is_break(ast_obj):
 End of AST type checking funcitons.
 """
 
+# AST classes used on the hot paths of graph construction, bound to module names
+# so each type check is a single global lookup
+_Assign = ast.Assign
+_Expr = ast.Expr
+_Call = ast.Call
+_Pass = ast.Pass
+_Return = ast.Return
+_Raise = ast.Raise
+_Continue = ast.Continue
+_Attribute = ast.Attribute
+_Name = ast.Name
+_Subscript = ast.Subscript
+_Str = ast.Str
+_Num = ast.Num
+_Tuple = ast.Tuple
+_Load = ast.Load
+_Index = ast.Index
+_iter_child_nodes = ast.iter_child_nodes
+
+# nodes that can't contain calls, so never need to be traversed
+_CALL_FREE_TYPES = (ast.Name, ast.Str, ast.Num, ast.Load, ast.Store)
+
+# statements whose value can be a call that we care about
+_CALL_STATEMENT_TYPES = (ast.Expr, ast.Assign)
+
+# statements after which control-flow doesn't continue to the next statement
+_TERMINATING_STATEMENT_TYPES = (ast.Return, ast.Raise)
+
+# names given to the empty vertices that mark control-flow structures.
+# these are shared by every such vertex, so are immutable
+CONDITIONAL_MARKER = ("conditional",)
+POST_CONDITIONAL_MARKER = ("post-conditional",)
+TRY_CATCH_MARKER = ("try-catch",)
+POST_TRY_CATCH_MARKER = ("post-try-catch",)
+LOOP_MARKER = ("loop",)
+POST_LOOP_MARKER = ("post-loop",)
+WHILE_MARKER = ("while",)
+POST_WHILE_MARKER = ("post-while",)
+
+_MARKERS_BY_NAME = dict((marker, marker) for marker in [CONDITIONAL_MARKER, POST_CONDITIONAL_MARKER,
+                                                          TRY_CATCH_MARKER, POST_TRY_CATCH_MARKER,
+                                                          LOOP_MARKER, POST_LOOP_MARKER,
+                                                          WHILE_MARKER, POST_WHILE_MARKER])
+
+# each vertex is tagged with a category when its name is set, so the kind of vertex
+# can be found with a single integer comparison
+(_NORMAL_VERTEX, _CONDITIONAL_VERTEX, _POST_CONDITIONAL_VERTEX, _TRY_CATCH_VERTEX, _POST_TRY_CATCH_VERTEX,
+ _LOOP_VERTEX, _POST_LOOP_VERTEX, _WHILE_VERTEX, _POST_WHILE_VERTEX) = range(9)
+
+# the names of ordinary vertices are (unhashable) lists, so markers are recognised by identity
+_MARKER_CATEGORIES = {
+    id(CONDITIONAL_MARKER): _CONDITIONAL_VERTEX,
+    id(POST_CONDITIONAL_MARKER): _POST_CONDITIONAL_VERTEX,
+    id(TRY_CATCH_MARKER): _TRY_CATCH_VERTEX,
+    id(POST_TRY_CATCH_MARKER): _POST_TRY_CATCH_VERTEX,
+    id(LOOP_MARKER): _LOOP_VERTEX,
+    id(POST_LOOP_MARKER): _POST_LOOP_VERTEX,
+    id(WHILE_MARKER): _WHILE_VERTEX,
+    id(POST_WHILE_MARKER): _POST_WHILE_VERTEX,
+}
+
+# sets of categories, as bit masks with one bit per category
+_CONTROL_FLOW_CATEGORY_MASK = (1 << _CONDITIONAL_VERTEX | 1 << _LOOP_VERTEX | 1 << _TRY_CATCH_VERTEX |
+                               1 << _POST_CONDITIONAL_VERTEX | 1 << _POST_LOOP_VERTEX | 1 << _POST_TRY_CATCH_VERTEX)
+_POST_STRUCTURE_CATEGORY_MASK = 1 << _POST_CONDITIONAL_VERTEX | 1 << _POST_LOOP_VERTEX | 1 << _POST_TRY_CATCH_VERTEX
+_SKIPPED_AFTER_STATEMENT_CATEGORY_MASK = 1 << _POST_CONDITIONAL_VERTEX | 1 << _POST_TRY_CATCH_VERTEX
+
+
+def _walk_calls(obj):
+    """
+    For a given ast object, find all the function calls inside it (including obj itself).
+    We use an explicit stack rather than ast.walk to avoid its generator overhead,
+    and don't descend into nodes that can't contain calls.
+    """
+    calls = []
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        node_type = type(node)
+        if node_type is _Call:
+            calls.append(node)
+        elif node_type in _CALL_FREE_TYPES:
+            continue
+        # calls can be nested inside calls, so we always descend
+        stack.extend(_iter_child_nodes(node))
+    return calls
+
 
 def get_function_name_strings(obj):
     """
     For a given ast object, get the fully qualified function names of all function calls
     found in the object.
+    The same instructions are looked up repeatedly, so the names are cached on the object.
     """
-    chain = list(ast.walk(obj))
-    all_calls = list(filter(lambda item: type(item) is ast.Call, chain))
-    ##print(all_calls)
-    full_names = {}
-    for call in all_calls:
-        # construct the full function name for this call
-        current_item = call
-        full_names[call] = []
-        while not (type(current_item) is str):
-            if type(current_item) is ast.Call:
-                current_item = current_item.func
-            elif type(current_item) is ast.Attribute:
-                full_names[call].append(current_item.attr)
+    cached_names = getattr(obj, "_function_names_cache", None)
+    if not (cached_names is None):
+        # callers are free to modify the list they're given
+        return list(cached_names)
+
+    full_names = []
+    for call in _walk_calls(obj):
+        # construct the full function name for this call by walking down the function's value chain
+        names = []
+        current_item = call.func
+        while True:
+            current_type = type(current_item)
+            if current_type is _Attribute:
+                names.append(current_item.attr)
                 current_item = current_item.value
-            elif type(current_item) is ast.Name:
-                full_names[call].append(current_item.id)
-                current_item = current_item.id
-            elif type(current_item) is ast.Str:
-                # full_names[call].append(current_item.s)
-                current_item = current_item.s
-            elif type(current_item) is ast.Subscript:
+            elif current_type is _Call:
+                current_item = current_item.func
+            elif current_type is _Subscript:
                 current_item = current_item.value
-    return list(map(lambda item: ".".join(reversed(item)), full_names.values()))
+            elif current_type is _Name:
+                names.append(current_item.id)
+                break
+            else:
+                # string literals (eg, "".join) and anything else end the chain
+                break
+        names.reverse()
+        full_names.append(".".join(names))
+
+    try:
+        obj._function_names_cache = tuple(full_names)
+    except AttributeError:
+        pass
+    return full_names
 
 
 def get_reversed_string_list(obj, omit_subscripts=False):
     """
     For a given ast object, find the reversed list representation of the names inside it.
     Eg, A.b() will give [b, A]
+    We walk down the chain of values iteratively, accumulating the names as we go.
     """
-    if type(obj) is ast.Name:
-        return [obj.id]
-    elif type(obj) is ast.Attribute:
-        return [obj.attr] + get_reversed_string_list(obj.value, omit_subscripts=omit_subscripts)
-    elif type(obj) is ast.Subscript:
-        if omit_subscripts:
-            return get_reversed_string_list(obj.value)
-        else:
-            if type(obj.slice.value) is ast.Str:
-                return ["[\"%s\"]" % obj.slice.value.s] + get_reversed_string_list(obj.value,
-                                                                                   omit_subscripts=omit_subscripts)
-            elif type(obj.slice.value) is ast.Num:
-                return ["[%i]" % obj.slice.value.n] + get_reversed_string_list(obj.value,
-                                                                               omit_subscripts=omit_subscripts)
-            elif type(obj.slice.value) is ast.Name:
-                return ["[%s]" % obj.slice.value.id] + get_reversed_string_list(obj.value,
-                                                                                omit_subscripts=omit_subscripts)
-            elif type(obj.slice.value) is ast.Subscript:
-                return ["[...]"] + get_reversed_string_list(obj.value, omit_subscripts=omit_subscripts)
-            elif type(obj.slice.value) is ast.Call:
-                if type(obj.slice.value.func) is ast.Attribute:
-                    return [get_attr_name_string(obj.slice.value.func)]
+    parts = []
+    while True:
+        obj_type = type(obj)
+        if obj_type is _Name:
+            parts.append(obj.id)
+            return parts
+        elif obj_type is _Attribute:
+            parts.append(obj.attr)
+            obj = obj.value
+        elif obj_type is _Subscript:
+            if omit_subscripts:
+                # only the outermost subscript is omitted
+                omit_subscripts = False
+                obj = obj.value
+                continue
+            slice_value = obj.slice.value
+            slice_type = type(slice_value)
+            if slice_type is _Str:
+                parts.append("[\"%s\"]" % slice_value.s)
+            elif slice_type is _Num:
+                parts.append("[%i]" % slice_value.n)
+            elif slice_type is _Name:
+                parts.append("[%s]" % slice_value.id)
+            elif slice_type is _Subscript:
+                parts.append("[...]")
+            elif slice_type is _Call:
+                if type(slice_value.func) is _Attribute:
+                    parts.append(get_attr_name_string(slice_value.func))
                 else:
-                    return [obj.slice.value.func.id]
-    elif type(obj) is ast.Call:
-        return get_function_name_strings(obj)
-    elif type(obj) is ast.Str:
-        return [obj.s]
-    else:
-        return [str(obj)]
+                    parts.append(slice_value.func.id)
+                return parts
+            else:
+                return None
+            obj = obj.value
+        elif obj_type is _Call:
+            return parts + get_function_name_strings(obj)
+        elif obj_type is _Str:
+            parts.append(obj.s)
+            return parts
+        else:
+            parts.append(str(obj))
+            return parts
 
 
 def get_attr_name_string(obj, omit_subscripts=False):
     """
-    For an ast object
+    For an ast object, get the string representation of the name it refers to.
+    The same targets are looked up repeatedly, so the result is cached on the object.
     """
-    attr_string = ""
-    if type(obj) in [ast.Load, ast.Index]:
+    cached = getattr(obj, "_attr_name_cache", None)
+    if not (cached is None) and cached[0] == omit_subscripts:
+        return cached[1]
+
+    attr_string = _compute_attr_name_string(obj, omit_subscripts)
+    try:
+        obj._attr_name_cache = (omit_subscripts, attr_string)
+    except AttributeError:
+        pass
+    return attr_string
+
+
+def _compute_attr_name_string(obj, omit_subscripts):
+    obj_type = type(obj)
+    if obj_type is _Load or obj_type is _Index:
         return None
     else:
         result = get_reversed_string_list(obj, omit_subscripts=omit_subscripts)[::-1]
-        for (n, part) in enumerate(result):
+        # collect the parts and join them once at the end, rather than building the string up
+        string_parts = []
+        separator = ""
+        for part in result:
             if "." in part and len(result) > 1:
                 # all cases in the will be covered individually by traversal
                 return None
             else:
                 if part[0] != "[":
-                    attr_string += "%s%s" % ("." if n != 0 else "", part)
-                else:
-                    attr_string += part
-        return attr_string
+                    string_parts.append(separator)
+                string_parts.append(part)
+            separator = "."
+        return "".join(string_parts)
 
 
 class CFGVertex(object):
@@ -170,7 +301,10 @@ class CFGVertex(object):
     This class represents a vertex in a control flow graph.
     """
 
-    def __init__(self, entry=None, path_length=None, structure_obj=None, reference_variables=[]):
+    __slots__ = ("_path_length", "_structure_obj", "_entry", "_reference_variables", "_name_changed_cache",
+                 "_category", "edges", "_previous_edge", "post_conditional_vertex", "post_try_catch_vertex")
+
+    def __init__(self, entry=None, path_length=None, structure_obj=None, reference_variables=None):
         """
         Given the name changed in the state this vertex represents, store it.
         """
@@ -179,47 +313,90 @@ class CFGVertex(object):
         # structure_obj is so vertices for control-flow such as conditionals and loops have a reference
         # to the ast object that generated them
         self._structure_obj = structure_obj
-        if not (entry):
-            self._name_changed = []
-        else:
-            if type(entry) is ast.Assign and type(entry.value) in [ast.Call, ast.Expr]:
-                # only works for a single function being called - should make this recursive
-                # for complex expressions that require multiple calls
-                if type(entry.targets[0]) is ast.Tuple:
-                    self._name_changed = list(
-                        list(map(get_attr_name_string, entry.targets[0].elts)) + get_function_name_strings(entry)
-                    )
-                else:
-                    self._name_changed = [get_attr_name_string(entry.targets[0])] + get_function_name_strings(entry)
-            # TODO: include case where the expression on the right hand side of the assignment is an expression with
-            #  a call
-            elif type(entry) is ast.Expr and type(entry.value) is ast.Call:
-                # if there are reference variables, we include them as possibly changed
-                self._name_changed = get_function_name_strings(entry.value) + (
-                    reference_variables if len(entry.value.args) > 0 else [])
-            elif type(entry) is ast.Assign:
-                self._name_changed = [get_attr_name_string(entry.targets[0])]
-            elif type(entry) is ast.Return:
-                if type(entry.value) is ast.Call:
-                    self._name_changed = get_function_name_strings(entry.value)
-                else:
-                    # nothing else could be changed
-                    self._name_changed = []
-            elif type(entry) is ast.Raise:
-                if type(entry.type) is ast.Call:
-                    if type(entry.type.func) is ast.Attribute:
-                        self._name_changed = [get_attr_name_string(entry.type.func)]
-                    else:
-                        self._name_changed = [entry.type.func.id]
-                else:
-                    self._name_changed = []
-            elif type(entry) is ast.Pass:
-                self._name_changed = ["pass"]
-            elif type(entry) is ast.Continue:
-                self._name_changed = ["continue"]
+        # the names changed are only computed from the entry the first time they're needed,
+        # since many vertices are never queried
+        self._entry = entry
+        self._reference_variables = reference_variables if not (reference_variables is None) else ()
+        self._name_changed_cache = None
+        self._category = _NORMAL_VERTEX
 
         self.edges = []
         self._previous_edge = None
+        # only set on the vertices at the start of conditionals and try-catch blocks
+        self.post_conditional_vertex = None
+        self.post_try_catch_vertex = None
+
+    def __getstate__(self):
+        # without a __dict__, pickle needs the state to be given explicitly
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, value)
+        # restore the shared marker, so control-flow vertices can still be recognised by identity
+        name_changed = self._name_changed_cache
+        if type(name_changed) is tuple:
+            self._name_changed_cache = _MARKERS_BY_NAME.get(name_changed, name_changed)
+
+    @property
+    def _name_changed(self):
+        if self._name_changed_cache is None:
+            self._name_changed_cache = self._compute_name_changed()
+        return self._name_changed_cache
+
+    @_name_changed.setter
+    def _name_changed(self, name_changed):
+        # control-flow vertices have their names set explicitly during graph construction
+        self._name_changed_cache = name_changed
+        self._category = _MARKER_CATEGORIES.get(id(name_changed), _NORMAL_VERTEX)
+
+    def _compute_name_changed(self):
+        """
+        Determine the names changed by the statement this vertex was constructed from.
+        """
+        entry = self._entry
+        if not (entry):
+            return []
+
+        # compute the types we dispatch on once
+        entry_type = type(entry)
+        value_type = type(getattr(entry, "value", None))
+        if entry_type is _Assign and (value_type is _Call or value_type is _Expr):
+            # only works for a single function being called - should make this recursive
+            # for complex expressions that require multiple calls
+            if type(entry.targets[0]) is _Tuple:
+                return [get_attr_name_string(element) for element in entry.targets[0].elts] + \
+                       get_function_name_strings(entry)
+            else:
+                return [get_attr_name_string(entry.targets[0])] + get_function_name_strings(entry)
+        # TODO: include case where the expression on the right hand side of the assignment is an expression with
+        #  a call
+        elif entry_type is _Expr and value_type is _Call:
+            # if there are reference variables, we include them as possibly changed
+            return get_function_name_strings(entry.value) + (
+                list(self._reference_variables) if len(entry.value.args) > 0 else [])
+        elif entry_type is _Assign:
+            return [get_attr_name_string(entry.targets[0])]
+        elif entry_type is _Return:
+            if value_type is _Call:
+                return get_function_name_strings(entry.value)
+            else:
+                # nothing else could be changed
+                return []
+        elif entry_type is _Raise:
+            if type(entry.type) is _Call:
+                if type(entry.type.func) is _Attribute:
+                    return [get_attr_name_string(entry.type.func)]
+                else:
+                    return [entry.type.func.id]
+            else:
+                return []
+        elif entry_type is _Pass:
+            return ["pass"]
+        elif entry_type is _Continue:
+            return ["continue"]
+        else:
+            return []
 
     def add_outgoing_edge(self, edge):
         edge._source_state = self
@@ -234,48 +411,81 @@ class CFGEdge(object):
     This class represents an edge in a control flow graph.
     """
 
+    __slots__ = ("_condition", "_instruction", "_source_state", "_target_state", "_target_category", "_operates_on",
+                 "_callee_names")
+
     def __init__(self, condition, instruction=None):
         # the condition has to be copied, otherwise later additions to the condition on the same branch
         # for example, to indicate divergence and convergence of control flow
         # will also be reflected in conditions earlier in the branch
-        self._condition = [c for c in condition] if type(condition) is list else condition
+        self._condition = condition[:] if type(condition) is list else condition
         self._instruction = instruction
         self._source_state = None
         self._target_state = None
-
-        if type(self._instruction) is ast.Assign and type(self._instruction.value) in [ast.Call, ast.Expr]:
+        # the category of the target state, stored here since it's needed whenever the edge is classified
+        self._target_category = None
+        # the names of the functions called by the instruction, computed the first time they're needed
+        self._callee_names = None
+
+        # compute the types we dispatch on once
+        instruction_type = type(instruction)
+        value_type = type(getattr(instruction, "value", None))
+        if instruction_type is _Assign and (value_type is _Call or value_type is _Expr):
             # we will have to deal with other kinds of expressions at some point
-            if type(self._instruction.targets[0]) is ast.Tuple:
-                self._operates_on = list(map(get_attr_name_string,
-                                             self._instruction.targets[0].elts) + get_function_name_strings(
-                    self._instruction.value))
+            if type(instruction.targets[0]) is _Tuple:
+                self._operates_on = [get_attr_name_string(element) for element in instruction.targets[0].elts] + \
+                                    get_function_name_strings(instruction.value)
             else:
-                self._operates_on = [get_attr_name_string(self._instruction.targets[0])] + \
-                                    get_function_name_strings(self._instruction.value)
+                self._operates_on = [get_attr_name_string(instruction.targets[0])] + \
+                                    get_function_name_strings(instruction.value)
         # print(self._operates_on)
-        elif type(self._instruction) is ast.Assign and not (type(self._instruction.value) is ast.Call):
+        elif instruction_type is _Assign and not (value_type is _Call):
             # print("constructed string: ", get_attr_name_string(self._instruction.targets[0]))
-            self._operates_on = get_attr_name_string(self._instruction.targets[0])
-        elif type(self._instruction) is ast.Expr and hasattr(self._instruction.value, "func"):
-            self._operates_on = get_function_name_strings(self._instruction.value)
-        elif type(self._instruction) is ast.Return and type(self._instruction.value) is ast.Call:
-            self._operates_on = get_function_name_strings(self._instruction.value)
-        elif type(self._instruction) is ast.Raise:
-            if type(self._instruction.type) is ast.Call:
-                if type(self._instruction.type.func) is ast.Attribute:
-                    self._operates_on = [get_attr_name_string(self._instruction.type.func)]
+            self._operates_on = get_attr_name_string(instruction.targets[0])
+        elif instruction_type is _Expr and hasattr(instruction.value, "func"):
+            self._operates_on = get_function_name_strings(instruction.value)
+        elif instruction_type is _Return and value_type is _Call:
+            self._operates_on = get_function_name_strings(instruction.value)
+        elif instruction_type is _Raise:
+            if type(instruction.type) is _Call:
+                if type(instruction.type.func) is _Attribute:
+                    self._operates_on = [get_attr_name_string(instruction.type.func)]
                 else:
-                    self._operates_on = [self._instruction.type.func.id]
+                    self._operates_on = [instruction.type.func.id]
             else:
                 self._operates_on = []
 
-        elif type(self._instruction) is ast.Pass:
+        elif instruction_type is _Pass:
             self._operates_on = ["pass"]
         else:
-            self._operates_on = [self._instruction]
+            self._operates_on = [instruction]
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, value)
+
+    def get_callee_names(self):
+        """
+        Get the names of the functions called by this edge's instruction, if it's a call statement
+        or an assignment of the result of a call.
+        """
+        callee_names = self._callee_names
+        if callee_names is None:
+            instruction = self._instruction
+            # only calls have a func attribute, so both kinds of statement are checked in the same way
+            if isinstance(instruction, _CALL_STATEMENT_TYPES) and isinstance(instruction.value, _Call):
+                callee_names = get_function_name_strings(instruction.value)
+            else:
+                callee_names = []
+            self._callee_names = callee_names
+        return callee_names
 
     def set_target_state(self, state):
         self._target_state = state
+        self._target_category = state._category
         """if not(type(self._instruction) is str):
             state._previous_edge = self"""
         state._previous_edge = self
@@ -289,7 +499,7 @@ class CFG(object):
     This class represents a symbolic control flow graph.
     """
 
-    def __init__(self, reference_variables=[]):
+    def __init__(self, reference_variables=None):
         self.vertices = []
         self.edges = []
         empty_vertex = CFGVertex()
@@ -297,726 +507,793 @@ class CFG(object):
         self.starting_vertices = empty_vertex
         self.return_statements = []
         self.branch_initial_statements = []
-        self.reference_variables = reference_variables
+        self.reference_variables = reference_variables if not (reference_variables is None) else ()
         # we have a stack of continue vertices so we can construct edges going from continue vertices
         # to the end of loops once they've been computed
         self.continue_vertex_stack = []
+        # the grammar is derived once, and then reused until the graph changes
+        self._grammar = None
 
-    def process_block(self, block, starting_vertices=None, condition=[], closest_loop=None):
+    def process_block(self, block, starting_vertices=None, condition=None, closest_loop=None):
         """
         Given a block, a set of starting vertices and to put on the first edge,
         construct the section of the control flow graph corresponding to this block.
         """
+        # the graph is about to change, so any grammar derived from it is out of date
+        self._grammar = None
         # make a copy of the condition sequence for this branch
-        condition = [c for c in condition]
+        condition = condition[:] if not (condition is None) else []
         current_vertices = starting_vertices if not (starting_vertices is None) else [self.starting_vertices]
         path_length = 0
-
-        for (n, entry) in enumerate(block):
-            # print("processing block")
-            if ast_is_assign(entry) or (ast_is_expr(entry) and ast_is_call(entry.value)):
-                path_length += 1
-                # print("processing assignment")
-
-                # for each vertex in current_vertices, add an edge
-                new_edges = []
-                for vertex in current_vertices:
-                    entry._parent_body = block
-                    # print("constructing new edge")
-                    new_edge = CFGEdge(condition, entry)
-                    new_edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-
-                # create a new vertex for the state created here
-                new_vertex = CFGVertex(entry, path_length=path_length, reference_variables=self.reference_variables)
-
-                self.vertices.append(new_vertex)
-                self.edges += new_edges
-
-                # direct all new edges to this new vertex
-                for edge in new_edges:
-                    edge.set_target_state(new_vertex)
-
-                # update current vertices
-                current_vertices = [new_vertex]
-
-            elif ast_is_pass(entry):
-                path_length += 1
-                entry._parent_body = block
-
-                # for each vertex in current_vertices, add an edge
-                new_edges = []
-                for vertex in current_vertices:
-                    entry._parent_body = block
-                    # print("constructing new edge")
-                    new_edge = CFGEdge(condition, entry)
-                    new_edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-
-                # create a new vertex for the state created here
-                new_vertex = CFGVertex(entry, path_length=path_length)
-
-                self.vertices.append(new_vertex)
-                self.edges += new_edges
-
-                # direct all new edges to this new vertex
-                for edge in new_edges:
-                    edge.set_target_state(new_vertex)
-
-                # update current vertices
-                current_vertices = [new_vertex]
-
-            elif ast_is_return(entry):
-                path_length += 1
-
-                new_edges = []
-                for vertex in current_vertices:
-                    entry._parent_body = block
-                    new_edge = CFGEdge(condition, entry)
-                    new_edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-
-                new_vertex = CFGVertex(entry, path_length=path_length)
-
-                self.vertices.append(new_vertex)
-                self.edges += new_edges
-
-                # direct all new edges to this new vertex
-                for edge in new_edges:
-                    edge.set_target_state(new_vertex)
-
-                # update current vertices
-                current_vertices = [new_vertex]
-
-                self.return_statements.append(new_vertex)
-
-            elif ast_is_raise(entry):
-                path_length += 1
-
-                new_edges = []
-                for vertex in current_vertices:
-                    entry._parent_body = block
-                    new_edge = CFGEdge(condition, entry)
-                    new_edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-
-                new_vertex = CFGVertex(entry, path_length=path_length)
-
-                self.vertices.append(new_vertex)
-                self.edges += new_edges
-
-                # direct all new edges to this new vertex
-                for edge in new_edges:
-                    edge.set_target_state(new_vertex)
-
-                # update current vertices
-                current_vertices = [new_vertex]
-
-            elif ast_is_break(entry):
-                # we assume that we're inside a loop
-                # this instruction doesn't generate a vertex - rather it generates an edge
-                # leading to the ending vertex given by closest_loop
-                path_length += 1
-
-                loop_ending_edge = CFGEdge("break", "break")
-                self.edges.append(loop_ending_edge)
-                loop_ending_edge.set_target_state(closest_loop)
-                for vertex in current_vertices:
-                    vertex.add_outgoing_edge(loop_ending_edge)
-
-                """# direct all new edges to this new vertex
-                for edge in new_edges:
-                    edge.set_target_state(new_vertex)"""
-
-                # set the current_vertices to empty so no constructs can make an edge
-                # from the preceding statement
-                current_vertices = []
-
-            elif ast_is_continue(entry):
-                # we assume that we're inside a loop
-                # this instruction generates a continue vertex
-                # which is picked up by the post-loop processing so an edge can be added from this vertex
-                # to the last vertex of the loop body
-                path_length += 1
-
-                new_edges = []
-                for vertex in current_vertices:
-                    entry._parent_body = block
-                    new_edge = CFGEdge(condition, entry)
-                    new_edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-
-                new_vertex = CFGVertex(entry)
-
-                self.vertices.append(new_vertex)
-                self.edges += new_edges
-
-                # direct all new edges to this new vertex
-                for edge in new_edges:
-                    edge.set_target_state(new_vertex)
-
-                # add this continue vertex to the continue vertex stack
-                self.continue_vertex_stack.append(new_vertex)
-
-                # continue ends control-flow on this branch, so we can return to processing the block above
+        # the handler lookup is done once per statement, so bind it locally
+        get_handler = _STATEMENT_HANDLERS.get
+
+        for entry in block:
+            # find the method that deals with this kind of statement
+            handler = get_handler(type(entry))
+            if handler is None:
+                # this statement has no effect on the graph
+                continue
+
+            (current_vertices, path_length) = handler(
+                self, entry, block, current_vertices, condition, closest_loop, path_length
+            )
+
+            if current_vertices is None:
+                # the statement ended control-flow on this branch (eg, continue),
+                # so we can return to processing the block above
                 return []
 
-            elif ast_is_if(entry):
-
-                entry._parent_body = block
-                path_length += 1
+        return current_vertices
 
-                # if this conditional isn't the last element in its block, we need to place a post-conditional
-                # path recording instrument after it
-                if entry != entry._parent_body[-1]:
-                    self.branch_initial_statements.append(["post-conditional", entry])
+    def _link_simple(self, entry, block, current_vertices, condition, path_length):
+        """
+        Create a vertex for the state reached by a straight-line statement, and an edge
+        to it from each of the current vertices.
+        The edges are created, attached and registered in a single pass.
+        """
+        entry._parent_body = block
+
+        # create a new vertex for the state created here
+        new_vertex = CFGVertex(entry, path_length=path_length, reference_variables=self.reference_variables)
+        self.vertices.append(new_vertex)
+
+        # for each vertex in current_vertices, add an edge directed to the new vertex
+        edges = self.edges
+        for vertex in current_vertices:
+            new_edge = CFGEdge(condition, entry)
+            new_edge._source_state = vertex
+            vertex.edges.append(new_edge)
+            new_edge._target_state = new_vertex
+            new_edge._target_category = _NORMAL_VERTEX
+            new_vertex._previous_edge = new_edge
+            edges.append(new_edge)
+
+        # for these statements, the names changed by the vertex are exactly those the edges operate on,
+        # so we reuse them rather than computing them from the entry again
+        entry_type = type(entry)
+        if len(current_vertices) > 0 and (entry_type is _Pass or entry_type is _Raise or
+                                          (entry_type is _Return and type(entry.value) is _Call)):
+            new_vertex._name_changed = list(new_edge._operates_on)
+
+        return new_vertex
+
+    def _link_control_flow(self, current_vertices, condition, instruction, target_vertex):
+        """
+        Add an edge with the given condition and instruction from each of the current vertices
+        to target_vertex, which marks a control-flow structure.
+        The new edges are registered with the graph in one go.
+        """
+        new_edges = [CFGEdge(condition, instruction) for _ in current_vertices]
+        for (vertex, new_edge) in zip(current_vertices, new_edges):
+            vertex.add_outgoing_edge(new_edge)
+            new_edge.set_target_state(target_vertex)
+        self.edges.extend(new_edges)
 
-                # insert intermediate control flow vertex at the beginning of the block
-                empty_conditional_vertex = CFGVertex(structure_obj=entry)
-                empty_conditional_vertex._name_changed = ['conditional']
-                self.vertices.append(empty_conditional_vertex)
+    def _handle_simple(self, entry, block, current_vertices, condition, closest_loop, path_length):
+        """
+        Handle a straight-line statement - an assignment, a function call, pass, return or raise.
+        """
+        path_length += 1
+        new_vertex = self._link_simple(entry, block, current_vertices, condition, path_length)
+        if type(entry) is _Return:
+            self.return_statements.append(new_vertex)
+        return ([new_vertex], path_length)
 
-                # connect empty_conditional_vertex to the graph constructed so far
-                for vertex in current_vertices:
-                    new_edge = CFGEdge("conditional", "control-flow")
-                    self.edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-                    new_edge.set_target_state(empty_conditional_vertex)
-                current_vertices = [empty_conditional_vertex]
+    def _handle_expr(self, entry, block, current_vertices, condition, closest_loop, path_length):
+        """
+        Expressions only change the state if they're function calls.
+        """
+        if ast_is_call(entry.value):
+            return self._handle_simple(entry, block, current_vertices, condition, closest_loop, path_length)
+        else:
+            return (current_vertices, path_length)
+
+    def _handle_break(self, entry, block, current_vertices, condition, closest_loop, path_length):
+        # we assume that we're inside a loop
+        # this instruction doesn't generate a vertex - rather it generates an edge
+        # leading to the ending vertex given by closest_loop
+        path_length += 1
+
+        loop_ending_edge = CFGEdge("break", "break")
+        self.edges.append(loop_ending_edge)
+        loop_ending_edge.set_target_state(closest_loop)
+        for vertex in current_vertices:
+            vertex.add_outgoing_edge(loop_ending_edge)
+
+        # set the current_vertices to empty so no constructs can make an edge
+        # from the preceding statement
+        return ([], path_length)
+
+    def _handle_continue(self, entry, block, current_vertices, condition, closest_loop, path_length):
+        # we assume that we're inside a loop
+        # this instruction generates a continue vertex
+        # which is picked up by the post-loop processing so an edge can be added from this vertex
+        # to the last vertex of the loop body
+        path_length += 1
+
+        # continue vertices don't record a path length
+        new_vertex = self._link_simple(entry, block, current_vertices, condition, None)
+
+        # add this continue vertex to the continue vertex stack
+        self.continue_vertex_stack.append(new_vertex)
+
+        # continue ends control-flow on this branch, which we signal with no current vertices
+        return (None, path_length)
+
+    def _handle_if(self, entry, block, current_vertices, condition, closest_loop, path_length):
+        entry._parent_body = block
+        path_length += 1
+
+        # if this conditional isn't the last element in its block, we need to place a post-conditional
+        # path recording instrument after it
+        if entry != entry._parent_body[-1]:
+            self.branch_initial_statements.append(["post-conditional", entry])
+
+        # insert intermediate control flow vertex at the beginning of the block
+        empty_conditional_vertex = CFGVertex(structure_obj=entry)
+        empty_conditional_vertex._name_changed = CONDITIONAL_MARKER
+        self.vertices.append(empty_conditional_vertex)
+
+        # connect empty_conditional_vertex to the graph constructed so far
+        self._link_control_flow(current_vertices, "conditional", "control-flow", empty_conditional_vertex)
+        current_vertices = [empty_conditional_vertex]
+
+        # process the conditional block
+        current_conditional = [entry]
+        final_else_is_present = False
+        final_conditional_vertices = []
+        branch_number = 0
+
+        # process the main body, and then iterate downwards
+        final_vertices = self.process_block(
+            current_conditional[0].body,
+            current_vertices,
+            [current_conditional[0].test],
+            closest_loop
+        )
+        # add to the list of final vertices that need to be connected to the post-conditional vertex
+        final_conditional_vertices += final_vertices
+        # add the branching statement
+        self.branch_initial_statements.append(
+            ["conditional", current_conditional[0].body[0], branch_number]
+        )
+        branch_number += 1
+
+        # we now repeat the same, but iterating through the conditional structure
+        while type(current_conditional[0]) is ast.If:
+            current_conditional = current_conditional[0].orelse
+            if len(current_conditional) == 1:
+
+                # there is just another conditional block, so process it as if it were a branch
+                if type(current_conditional[0]) is ast.If:
+                    # pairs.append(
+                    #     (current_condition_set + [current_conditional[0].test], current_conditional[0].body))
+                    # current_condition_set.append(formula_tree.lnot(current_conditional[0].test))
+                    final_vertices = self.process_block(
+                        current_conditional[0].body,
+                        current_vertices,
+                        [current_conditional[0].test],
+                        closest_loop
+                    )
+                    # add to the list of final vertices that need to be connected to the post-conditional vertex
+                    final_conditional_vertices += final_vertices
+                    # add the branching statement
+                    self.branch_initial_statements.append(
+                        ["conditional", current_conditional[0].body[0], branch_number]
+                    )
+                    branch_number += 1
 
-                # process the conditional block
-                current_conditional = [entry]
-                final_else_is_present = False
-                final_conditional_vertices = []
-                branch_number = 0
+                else:
+                    # the else block contains an instruction that isn't a conditional
+                    # pairs.append((current_condition_set, current_conditional))
+                    final_vertices = self.process_block(
+                        current_conditional,
+                        current_vertices,
+                        ["else"],
+                        closest_loop
+                    )
+                    # we reached an else block
+                    final_else_is_present = True
+                    # add to the list of final vertices that need to be connected to the post-conditional vertex
+                    final_conditional_vertices += final_vertices
+                    # add the branching statement
+                    self.branch_initial_statements.append(
+                        ["conditional", current_conditional[0], branch_number]
+                    )
+                    branch_number += 1
 
-                # process the main body, and then iterate downwards
+            elif len(current_conditional) > 1:
+                # there are multiple blocks inside the orelse, so we can't treat this like another branch
                 final_vertices = self.process_block(
-                    current_conditional[0].body,
+                    current_conditional,
                     current_vertices,
-                    [current_conditional[0].test],
+                    ["else"],
                     closest_loop
                 )
-                # add to the list of final vertices that need to be connected to the post-conditional vertex
                 final_conditional_vertices += final_vertices
-                # add the branching statement
                 self.branch_initial_statements.append(
-                    ["conditional", current_conditional[0].body[0], branch_number]
+                    ["conditional", current_conditional[0], branch_number]
                 )
-                branch_number += 1
-
-                # we now repeat the same, but iterating through the conditional structure
-                while type(current_conditional[0]) is ast.If:
-                    current_conditional = current_conditional[0].orelse
-                    if len(current_conditional) == 1:
-
-                        # there is just another conditional block, so process it as if it were a branch
-                        if type(current_conditional[0]) is ast.If:
-                            # pairs.append(
-                            #     (current_condition_set + [current_conditional[0].test], current_conditional[0].body))
-                            # current_condition_set.append(formula_tree.lnot(current_conditional[0].test))
-                            final_vertices = self.process_block(
-                                current_conditional[0].body,
-                                current_vertices,
-                                [current_conditional[0].test],
-                                closest_loop
-                            )
-                            # add to the list of final vertices that need to be connected to the post-conditional vertex
-                            final_conditional_vertices += final_vertices
-                            # add the branching statement
-                            self.branch_initial_statements.append(
-                                ["conditional", current_conditional[0].body[0], branch_number]
-                            )
-                            branch_number += 1
-
-                        else:
-                            # the else block contains an instruction that isn't a conditional
-                            # pairs.append((current_condition_set, current_conditional))
-                            final_vertices = self.process_block(
-                                current_conditional,
-                                current_vertices,
-                                ["else"],
-                                closest_loop
-                            )
-                            # we reached an else block
-                            final_else_is_present = True
-                            # add to the list of final vertices that need to be connected to the post-conditional vertex
-                            final_conditional_vertices += final_vertices
-                            # add the branching statement
-                            self.branch_initial_statements.append(
-                                ["conditional", current_conditional[0], branch_number]
-                            )
-                            branch_number += 1
-
-                    elif len(current_conditional) > 1:
-                        # there are multiple blocks inside the orelse, so we can't treat this like another branch
-                        final_vertices = self.process_block(
-                            current_conditional,
-                            current_vertices,
-                            ["else"],
-                            closest_loop
-                        )
-                        final_conditional_vertices += final_vertices
-                        self.branch_initial_statements.append(
-                            ["conditional", current_conditional[0], branch_number]
-                        )
-                        # we reached an else block
-                        final_else_is_present = True
-                    else:
-                        # nowhere else to go in the traversal
-                        break
-
-                # we include the vertex before the conditional, only if there was no else
-                if not (final_else_is_present):
-                    # we add a branching statement - the branch number is just the number of pairs we found
-                    self.branch_initial_statements.append(["conditional-no-else", entry, branch_number])
-                    current_vertices = final_conditional_vertices + current_vertices
-                else:
-                    current_vertices = final_conditional_vertices
-
-                # filter out vertices that were returns or raises
-                # here we have to check for the previous edge existing, in case the program starts with a conditional
-                current_vertices = list(filter(
-                    lambda vertex: vertex._previous_edge is None or not (
-                            type(vertex._previous_edge._instruction) in [ast.Return, ast.Raise]),
-                    current_vertices
-                ))
-
-                # add an empty "control flow" vertex after the conditional
-                # to avoid transition duplication along the edges leaving
-                # the conditional
-                if len(current_vertices) > 0:
-                    empty_vertex = CFGVertex()
-                    empty_vertex._name_changed = ['post-conditional']
-                    # at the moment, used for grammar construction from the scfg
-                    empty_conditional_vertex.post_conditional_vertex = empty_vertex
-                    self.vertices.append(empty_vertex)
-                    for vertex in current_vertices:
-                        # an empty edge
-                        new_edge = CFGEdge("post-condition", "control-flow")
-                        self.edges.append(new_edge)
-                        new_edge.set_target_state(empty_vertex)
-                        vertex.add_outgoing_edge(new_edge)
-
-                    current_vertices = [empty_vertex]
-                else:
-                    empty_conditional_vertex.post_conditional_vertex = None
+                # we reached an else block
+                final_else_is_present = True
+            else:
+                # nowhere else to go in the traversal
+                break
+
+        # we include the vertex before the conditional, only if there was no else
+        if not (final_else_is_present):
+            # we add a branching statement - the branch number is just the number of pairs we found
+            self.branch_initial_statements.append(["conditional-no-else", entry, branch_number])
+            current_vertices = final_conditional_vertices + current_vertices
+        else:
+            current_vertices = final_conditional_vertices
+
+        # filter out vertices that were returns or raises
+        # here we have to check for the previous edge existing, in case the program starts with a conditional
+        current_vertices = [
+            vertex for vertex in current_vertices
+            if vertex._previous_edge is None
+            or not (type(vertex._previous_edge._instruction) in _TERMINATING_STATEMENT_TYPES)
+        ]
+
+        # add an empty "control flow" vertex after the conditional
+        # to avoid transition duplication along the edges leaving
+        # the conditional
+        if len(current_vertices) > 0:
+            empty_vertex = CFGVertex()
+            empty_vertex._name_changed = POST_CONDITIONAL_MARKER
+            # at the moment, used for grammar construction from the scfg
+            empty_conditional_vertex.post_conditional_vertex = empty_vertex
+            self.vertices.append(empty_vertex)
+            # empty edges
+            self._link_control_flow(current_vertices, "post-condition", "control-flow", empty_vertex)
+
+            current_vertices = [empty_vertex]
+        else:
+            empty_conditional_vertex.post_conditional_vertex = None
 
-                condition.append("skip-conditional")
+        condition.append("skip-conditional")
 
-                # reset path length for instructions after conditional
-                path_length = 0
+        # reset path length for instructions after conditional
+        path_length = 0
 
-            elif ast_is_try(entry):
-                entry._parent_body = block
-                path_length += 1
-                # print("processing try-except")
+        return (current_vertices, path_length)
+
+    def _handle_try(self, entry, block, current_vertices, condition, closest_loop, path_length):
+        entry._parent_body = block
+        path_length += 1
+        # print("processing try-except")
+
+        if entry != entry._parent_body[-1]:
+            self.branch_initial_statements.append(["post-try-catch", entry])
+
+        # insert intermediate control flow vertex at the beginning of the block
+        empty_conditional_vertex = CFGVertex()
+        empty_conditional_vertex._name_changed = TRY_CATCH_MARKER
+        self.vertices.append(empty_conditional_vertex)
+        self._link_control_flow(current_vertices, "try-catch", "control-flow", empty_conditional_vertex)
+        current_vertices = [empty_conditional_vertex]
+
+        blocks = []
+        self.branch_initial_statements.append(["try-catch", entry.body[0], "try-catch-main"])
+
+        # print("except handling blocks are:")
+
+        for except_handler in entry.handlers:
+            self.branch_initial_statements.append(["try-catch", except_handler.body[0], "try-catch-handler"])
+            # print(except_handler.body)
+            blocks.append(except_handler.body)
+
+        # print("final list of except blocks is")
+        # print(blocks)
+
+        # print("processing blocks")
+
+        # first process entry.body
+        final_try_catch_vertices = []
+
+        final_vertices = self.process_block(
+            entry.body,
+            current_vertices,
+            ['try-catch-main'],
+            closest_loop
+        )
+        final_try_catch_vertices += final_vertices
+
+        # now process the except handlers - eventually with some identifier for each branch
+
+        for block_item in blocks:
+            # print(block_item)
+            # print("="*10)
+            final_vertices = self.process_block(
+                block_item,
+                current_vertices,
+                ['try-catch-handler'],
+                closest_loop
+            )
+            final_try_catch_vertices += final_vertices
+        # print("="*10)
+
+        current_vertices = final_try_catch_vertices
+
+        # print(current_vertices)
+
+        # filter out vertices that were returns or raises
+        # this should be applied to the other cases as well - needs testing
+        current_vertices = [
+            vertex for vertex in current_vertices
+            if vertex._previous_edge is None
+            or not (type(vertex._previous_edge._instruction) in _TERMINATING_STATEMENT_TYPES)
+        ]
+
+        # print("processing try-except end statements")
+        # print(current_vertices)
+
+        if len(current_vertices) > 0:
+            empty_vertex = CFGVertex()
+            empty_vertex._name_changed = POST_TRY_CATCH_MARKER
+            empty_conditional_vertex.post_try_catch_vertex = empty_vertex
+            self.vertices.append(empty_vertex)
+            # empty edges
+            self._link_control_flow(current_vertices, "post-try-catch", "control-flow", empty_vertex)
+
+            current_vertices = [empty_vertex]
+        else:
+            empty_conditional_vertex.post_try_catch_vertex = None
 
-                if entry != entry._parent_body[-1]:
-                    self.branch_initial_statements.append(["post-try-catch", entry])
+        condition.append("skip-try-catch")
+        path_length = 0
 
-                # insert intermediate control flow vertex at the beginning of the block
-                empty_conditional_vertex = CFGVertex()
-                empty_conditional_vertex._name_changed = ['try-catch']
-                self.vertices.append(empty_conditional_vertex)
-                for vertex in current_vertices:
-                    new_edge = CFGEdge("try-catch", "control-flow")
-                    self.edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-                    new_edge.set_target_state(empty_conditional_vertex)
-                current_vertices = [empty_conditional_vertex]
+        return (current_vertices, path_length)
+
+    def _handle_for(self, entry, block, current_vertices, condition, closest_loop, path_length):
+        entry._parent_body = block
+        path_length += 1
+
+        # this will eventually be modified to include the loop variable as the state changed
+
+        empty_pre_loop_vertex = CFGVertex(structure_obj=entry)
+        empty_pre_loop_vertex._name_changed = LOOP_MARKER
+        empty_post_loop_vertex = CFGVertex()
+        empty_post_loop_vertex._name_changed = POST_LOOP_MARKER
+        self.vertices.append(empty_pre_loop_vertex)
+        self.vertices.append(empty_post_loop_vertex)
+
+        # link current_vertices to the pre-loop vertex
+        self._link_control_flow(current_vertices, entry.iter, "loop", empty_pre_loop_vertex)
+
+        current_vertices = [empty_pre_loop_vertex]
+
+        # process loop body
+        # first, determine the additional input variables that this loop induces
+        loop_variable = entry.target
+        if type(loop_variable) is ast.Name:
+            additional_input_variables = [loop_variable.id]
+        elif type(loop_variable) is ast.Tuple:
+            additional_input_variables = list(map(lambda item: item.id, loop_variable.elts))
+        final_vertices = self.process_block(
+            entry.body,
+            current_vertices,
+            ['enter-loop'],
+            empty_post_loop_vertex
+        )
+
+        # for a for loop, we add a path recording instrument at the beginning of the loop body
+        # and after the loop body
+        self.branch_initial_statements.append(["loop", entry.body[0], "enter-loop", entry, "end-loop"])
+
+        # add 2 edges from the final_vertex - one going back to the pre-loop vertex
+        # with the positive condition, and one going to the post loop vertex.
+
+        for final_vertex in final_vertices:
+            # there will probably only ever be one final vertex, but we register a branching vertex
+            # self.branching_vertices.append(final_vertex)
+            for base_vertex in current_vertices:
+                new_positive_edge = CFGEdge('loop-jump', 'loop-jump')
+                self.edges.append(new_positive_edge)
+                final_vertex.add_outgoing_edge(new_positive_edge)
+                new_positive_edge.set_target_state(base_vertex)
+
+                new_post_edge = CFGEdge("post-loop", "post-loop")
+                self.edges.append(new_post_edge)
+                final_vertex.add_outgoing_edge(new_post_edge)
+                new_post_edge.set_target_state(empty_post_loop_vertex)
+
+        # process all of the continue vertices on the stack
+        for continue_vertex in self.continue_vertex_stack:
+            new_edge = CFGEdge("post-loop", "post-loop")
+            self.edges.append(new_edge)
+            continue_vertex.add_outgoing_edge(new_edge)
+            new_edge.set_target_state(empty_pre_loop_vertex)
+            self.continue_vertex_stack.remove(continue_vertex)
+
+        skip_edge = CFGEdge(formula_tree.lnot(entry.iter), "loop-skip")
+        empty_pre_loop_vertex.add_outgoing_edge(skip_edge)
+        # skip_edge.set_target_state(final_vertices[0])
+        skip_edge.set_target_state(empty_post_loop_vertex)
+
+        current_vertices = [empty_post_loop_vertex]
+        # current_vertices = final_vertices
+
+        condition.append("skip-for-loop")
+
+        # reset path length for instructions after loop
+        path_length = 0
 
-                blocks = []
-                self.branch_initial_statements.append(["try-catch", entry.body[0], "try-catch-main"])
+        return (current_vertices, path_length)
 
-                # print("except handling blocks are:")
+    def _handle_while(self, entry, block, current_vertices, condition, closest_loop, path_length):
+        """
+        Handle a while loop in the same way as a for loop, but with while-specific vertices and edges.
+        """
+        """# needs work - but while loops haven't been a thing we've needed to handle so far
+        # need to add code to deal with branching vertices
+        path_length += 1
+
+        # this should be updated at some point to include empty pre and post-loop vertices like in the for
+        # loop clause above
+
+        final_vertices = self.process_block(entry.body, current_vertices, ['while'], closest_loop)
+
+        for final_vertex in final_vertices:
+            for base_vertex in current_vertices:
+                new_positive_edge = CFGEdge('for', 'loop-jump')
+                self.edges.append(new_positive_edge)
+                final_vertex.add_outgoing_edge(new_positive_edge)
+                new_positive_edge.set_target_state(base_vertex)
+
+        current_vertices = final_vertices"""
+
+        entry._parent_body = block
+        path_length += 1
+
+        empty_pre_loop_vertex = CFGVertex(structure_obj=entry)
+        empty_pre_loop_vertex._name_changed = WHILE_MARKER
+        empty_post_loop_vertex = CFGVertex()
+        empty_post_loop_vertex._name_changed = POST_WHILE_MARKER
+        self.vertices.append(empty_pre_loop_vertex)
+        self.vertices.append(empty_post_loop_vertex)
+
+        # link current_vertices to the pre-loop vertex
+        self._link_control_flow(current_vertices, entry.test, "while", empty_pre_loop_vertex)
+
+        current_vertices = [empty_pre_loop_vertex]
+
+        # process loop body
+        final_vertices = self.process_block(
+            entry.body,
+            current_vertices,
+            ['enter-while'],
+            empty_post_loop_vertex
+        )
+
+        # for a for loop, we add a path recording instrument at the beginning of the loop body
+        # and after the loop body
+        self.branch_initial_statements.append(["while", entry.body[0], "enter-while", entry, "end-while"])
+
+        # add 2 edges from the final_vertex - one going back to the pre-loop vertex
+        # with the positive condition, and one going to the post loop vertex.
+
+        for final_vertex in final_vertices:
+            # there will probably only ever be one final vertex, but we register a branching vertex
+            # self.branching_vertices.append(final_vertex)
+            for base_vertex in current_vertices:
+                new_positive_edge = CFGEdge('while-jump', 'while-jump')
+                self.edges.append(new_positive_edge)
+                final_vertex.add_outgoing_edge(new_positive_edge)
+                new_positive_edge.set_target_state(base_vertex)
+
+                new_post_edge = CFGEdge("post-while", "post-while")
+                self.edges.append(new_post_edge)
+                final_vertex.add_outgoing_edge(new_post_edge)
+                new_post_edge.set_target_state(empty_post_loop_vertex)
+
+        # process all of the continue vertices on the stack
+        for continue_vertex in self.continue_vertex_stack:
+            new_edge = CFGEdge("post-while", "post-while")
+            self.edges.append(new_edge)
+            continue_vertex.add_outgoing_edge(new_edge)
+            new_edge.set_target_state(empty_pre_loop_vertex)
+            self.continue_vertex_stack.remove(continue_vertex)
+
+        skip_edge = CFGEdge(formula_tree.lnot(entry.test), "while-skip")
+        empty_pre_loop_vertex.add_outgoing_edge(skip_edge)
+        # skip_edge.set_target_state(final_vertices[0])
+        skip_edge.set_target_state(empty_post_loop_vertex)
+
+        current_vertices = [empty_post_loop_vertex]
+        # current_vertices = final_vertices
+
+        condition.append("skip-while-loop")
+
+        # reset path length for instructions after loop
+        path_length = 0
 
-                for except_handler in entry.handlers:
-                    self.branch_initial_statements.append(["try-catch", except_handler.body[0], "try-catch-handler"])
-                    # print(except_handler.body)
-                    blocks.append(except_handler.body)
+        return (current_vertices, path_length)
 
-                # print("final list of except blocks is")
-                # print(blocks)
+    def derive_grammar(self):
+        """
+        Derive a dictionary mapping vertices to tuples of symbol tuples.
+        The symbols are either edges (terminal symbols) or vertices (non-terminal symbols).
+        The grammar is only derived the first time it's needed for the current graph.
+        """
+        if not (self._grammar is None):
+            return self._grammar
 
-                # print("processing blocks")
+        # print("constructing context free grammar from scfg")
+        # the rules are looked up by vertex when parse trees are built, and vertices hash by identity,
+        # so a dictionary lookup is already a single C-level operation - a list indexed by vertex position
+        # would need a Python-level wrapper for those lookups, which would be slower
+        final_map = {}
+        rule_functions = _GRAMMAR_RULE_FUNCTIONS
+        for vertex in self.vertices:
+            # print(vertex)
+            edges = vertex.edges
+            if len(edges) == 0:
+                # control flow can end at this vertex - the rule for it should just generate the empty string
+                final_map[vertex] = ((None,),)
+            else:
+                # the rules depend on the kind of vertex and the kind of vertex it leads to first
+                first_edge = edges[0]
+                rule_function = rule_functions.get((vertex._category, first_edge._target_category), _plain_rules)
+                final_map[vertex] = rule_function(edges, first_edge)
 
-                # first process entry.body
-                final_try_catch_vertices = []
+        # print(final_map[vertex])
 
-                final_vertices = self.process_block(
-                    entry.body,
-                    current_vertices,
-                    ['try-catch-main'],
-                    closest_loop
-                )
-                final_try_catch_vertices += final_vertices
+        self._grammar = final_map
+        return final_map
 
-                # now process the except handlers - eventually with some identifier for each branch
+    def next_calls(self, vertex, function):
+        """
+        Given a point (vertex or edge), find the list of next edges that model calls to function.
+        The graph is traversed depth-first with an explicit stack of edge iterators, so the calls
+        are found in the same order as a recursive traversal would find them.
+        """
+        calls = []
+        marked_vertices = set([vertex])
+        stack = [iter(vertex.edges)]
+        # bind the methods used for every edge
+        add_call = calls.append
+        mark_vertex = marked_vertices.add
+        push = stack.append
+        while stack:
+            edge = next(stack[-1], None)
+            if edge is None:
+                # all edges leaving this vertex have been explored
+                stack.pop()
+                continue
+            if function in edge.get_callee_names():
+                add_call(edge)
+            else:
+                # this edge is not what we're looking for
+                # so traverse this branch further
+                target_state = edge._target_state
+                if not (target_state in marked_vertices):
+                    mark_vertex(target_state)
+                    push(iter(target_state.edges))
+        return calls
 
-                for block_item in blocks:
-                    # print(block_item)
-                    # print("="*10)
-                    final_vertices = self.process_block(
-                        block_item,
-                        current_vertices,
-                        ['try-catch-handler'],
-                        closest_loop
-                    )
-                    final_try_catch_vertices += final_vertices
-                # print("="*10)
-
-                current_vertices = final_try_catch_vertices
-
-                # print(current_vertices)
-
-                # filter out vertices that were returns or raises
-                # this should be applied to the other cases as well - needs testing
-                current_vertices = list(filter(
-                    lambda vertex: vertex._previous_edge is None or not (
-                            type(vertex._previous_edge._instruction) in [ast.Return, ast.Raise]),
-                    current_vertices
-                ))
-
-                # print("processing try-except end statements")
-                # print(current_vertices)
-
-                if len(current_vertices) > 0:
-                    empty_vertex = CFGVertex()
-                    empty_vertex._name_changed = ['post-try-catch']
-                    empty_conditional_vertex.post_try_catch_vertex = empty_vertex
-                    self.vertices.append(empty_vertex)
-                    for vertex in current_vertices:
-                        # an empty edge
-                        new_edge = CFGEdge("post-try-catch", "control-flow")
-                        self.edges.append(new_edge)
-                        new_edge.set_target_state(empty_vertex)
-                        vertex.add_outgoing_edge(new_edge)
-
-                    current_vertices = [empty_vertex]
-                else:
-                    empty_conditional_vertex.post_try_catch_vertex = None
-
-                condition.append("skip-try-catch")
-                path_length = 0
-
-            elif ast_is_for(entry):
-                entry._parent_body = block
-                path_length += 1
-
-                # this will eventually be modified to include the loop variable as the state changed
-
-                empty_pre_loop_vertex = CFGVertex(structure_obj=entry)
-                empty_pre_loop_vertex._name_changed = ['loop']
-                empty_post_loop_vertex = CFGVertex()
-                empty_post_loop_vertex._name_changed = ['post-loop']
-                self.vertices.append(empty_pre_loop_vertex)
-                self.vertices.append(empty_post_loop_vertex)
-
-                # link current_vertices to the pre-loop vertex
-                for vertex in current_vertices:
-                    new_edge = CFGEdge(entry.iter, "loop")
-                    self.edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-                    new_edge.set_target_state(empty_pre_loop_vertex)
-
-                current_vertices = [empty_pre_loop_vertex]
-
-                # process loop body
-                # first, determine the additional input variables that this loop induces
-                loop_variable = entry.target
-                if type(loop_variable) is ast.Name:
-                    additional_input_variables = [loop_variable.id]
-                elif type(loop_variable) is ast.Tuple:
-                    additional_input_variables = list(map(lambda item: item.id, loop_variable.elts))
-                final_vertices = self.process_block(
-                    entry.body,
-                    current_vertices,
-                    ['enter-loop'],
-                    empty_post_loop_vertex
-                )
 
-                # for a for loop, we add a path recording instrument at the beginning of the loop body
-                # and after the loop body
-                self.branch_initial_statements.append(["loop", entry.body[0], "enter-loop", entry, "end-loop"])
-
-                # add 2 edges from the final_vertex - one going back to the pre-loop vertex
-                # with the positive condition, and one going to the post loop vertex.
-
-                for final_vertex in final_vertices:
-                    # there will probably only ever be one final vertex, but we register a branching vertex
-                    # self.branching_vertices.append(final_vertex)
-                    for base_vertex in current_vertices:
-                        new_positive_edge = CFGEdge('loop-jump', 'loop-jump')
-                        self.edges.append(new_positive_edge)
-                        final_vertex.add_outgoing_edge(new_positive_edge)
-                        new_positive_edge.set_target_state(base_vertex)
-
-                        new_post_edge = CFGEdge("post-loop", "post-loop")
-                        self.edges.append(new_post_edge)
-                        final_vertex.add_outgoing_edge(new_post_edge)
-                        new_post_edge.set_target_state(empty_post_loop_vertex)
-
-                # process all of the continue vertices on the stack
-                for continue_vertex in self.continue_vertex_stack:
-                    new_edge = CFGEdge("post-loop", "post-loop")
-                    self.edges.append(new_edge)
-                    continue_vertex.add_outgoing_edge(new_edge)
-                    new_edge.set_target_state(empty_pre_loop_vertex)
-                    self.continue_vertex_stack.remove(continue_vertex)
-
-                skip_edge = CFGEdge(formula_tree.lnot(entry.iter), "loop-skip")
-                empty_pre_loop_vertex.add_outgoing_edge(skip_edge)
-                # skip_edge.set_target_state(final_vertices[0])
-                skip_edge.set_target_state(empty_post_loop_vertex)
-
-                current_vertices = [empty_post_loop_vertex]
-                # current_vertices = final_vertices
-
-                condition.append("skip-for-loop")
-
-                # reset path length for instructions after loop
-                path_length = 0
-
-            elif ast_is_while(entry):
-                """# needs work - but while loops haven't been a thing we've needed to handle so far
-                # need to add code to deal with branching vertices
-                path_length += 1
-
-                # this should be updated at some point to include empty pre and post-loop vertices like in the for
-                # loop clause above
-
-                final_vertices = self.process_block(entry.body, current_vertices, ['while'], closest_loop)
-
-                for final_vertex in final_vertices:
-                    for base_vertex in current_vertices:
-                        new_positive_edge = CFGEdge('for', 'loop-jump')
-                        self.edges.append(new_positive_edge)
-                        final_vertex.add_outgoing_edge(new_positive_edge)
-                        new_positive_edge.set_target_state(base_vertex)
-
-                current_vertices = final_vertices"""
-
-                entry._parent_body = block
-                path_length += 1
-
-                empty_pre_loop_vertex = CFGVertex(structure_obj=entry)
-                empty_pre_loop_vertex._name_changed = ['while']
-                empty_post_loop_vertex = CFGVertex()
-                empty_post_loop_vertex._name_changed = ['post-while']
-                self.vertices.append(empty_pre_loop_vertex)
-                self.vertices.append(empty_post_loop_vertex)
-
-                # link current_vertices to the pre-loop vertex
-                for vertex in current_vertices:
-                    new_edge = CFGEdge(entry.test, "while")
-                    self.edges.append(new_edge)
-                    vertex.add_outgoing_edge(new_edge)
-                    new_edge.set_target_state(empty_pre_loop_vertex)
-
-                current_vertices = [empty_pre_loop_vertex]
-
-                # process loop body
-                final_vertices = self.process_block(
-                    entry.body,
-                    current_vertices,
-                    ['enter-while'],
-                    empty_post_loop_vertex
-                )
+"""
+Functions generating the grammar rules for a vertex, given its edges and the first of them.
+"""
 
-                # for a for loop, we add a path recording instrument at the beginning of the loop body
-                # and after the loop body
-                self.branch_initial_statements.append(["while", entry.body[0], "enter-while", entry, "end-while"])
 
-                # add 2 edges from the final_vertex - one going back to the pre-loop vertex
-                # with the positive condition, and one going to the post loop vertex.
+def _plain_rules(edges, first_edge):
+    # the vertex isn't followed by any special structure
+    return ((first_edge, first_edge._target_state),)
 
-                for final_vertex in final_vertices:
-                    # there will probably only ever be one final vertex, but we register a branching vertex
-                    # self.branching_vertices.append(final_vertex)
-                    for base_vertex in current_vertices:
-                        new_positive_edge = CFGEdge('while-jump', 'while-jump')
-                        self.edges.append(new_positive_edge)
-                        final_vertex.add_outgoing_edge(new_positive_edge)
-                        new_positive_edge.set_target_state(base_vertex)
 
-                        new_post_edge = CFGEdge("post-while", "post-while")
-                        self.edges.append(new_post_edge)
-                        final_vertex.add_outgoing_edge(new_post_edge)
-                        new_post_edge.set_target_state(empty_post_loop_vertex)
+def _skip_rules(edges, first_edge):
+    # the vertex leads straight to the end of a structure
+    return ((first_edge,),)
 
-                # process all of the continue vertices on the stack
-                for continue_vertex in self.continue_vertex_stack:
-                    new_edge = CFGEdge("post-while", "post-while")
-                    self.edges.append(new_edge)
-                    continue_vertex.add_outgoing_edge(new_edge)
-                    new_edge.set_target_state(empty_pre_loop_vertex)
-                    self.continue_vertex_stack.remove(continue_vertex)
 
-                skip_edge = CFGEdge(formula_tree.lnot(entry.test), "while-skip")
-                empty_pre_loop_vertex.add_outgoing_edge(skip_edge)
-                # skip_edge.set_target_state(final_vertices[0])
-                skip_edge.set_target_state(empty_post_loop_vertex)
+def _loop_back_rules(edges):
+    """
+    If one of the edges leads past the end of a loop, give the rules for branching
+    back to the loop or past it.  Otherwise, give None.
+    """
+    # in a single pass over the edges, check whether one leads past the end of a loop,
+    # and find the first edge going back to the loop and the first going anywhere else
+    leads_past_loop = False
+    reloop_edge = None
+    loop_skip_edge = None
+    for edge in edges:
+        target_category = edge._target_category
+        if target_category == _LOOP_VERTEX:
+            if reloop_edge is None:
+                reloop_edge = edge
+        else:
+            if target_category == _POST_LOOP_VERTEX:
+                leads_past_loop = True
+            if loop_skip_edge is None:
+                loop_skip_edge = edge
+
+    if leads_past_loop:
+        # we have to deal with some branching
+        return ((reloop_edge, reloop_edge._target_state), (loop_skip_edge,))
+    else:
+        return None
 
-                current_vertices = [empty_post_loop_vertex]
-                # current_vertices = final_vertices
 
-                condition.append("skip-while-loop")
+def _statement_to_statement_rules(edges, first_edge):
+    rules = _loop_back_rules(edges)
+    if rules is None:
+        # normal vertex that isn't followed by any special structure
+        rules = _plain_rules(edges, first_edge)
+    return rules
 
-                # reset path length for instructions after loop
-                path_length = 0
 
-        return current_vertices
+def _statement_to_loop_rules(edges, first_edge):
+    rules = _loop_back_rules(edges)
+    if rules is None:
+        first_target = first_edge._target_state
+        post_loop_vertex = next(
+            edge for edge in first_target.edges if edge._target_category == _POST_LOOP_VERTEX
+        )._target_state
+        rules = ((first_edge, first_target, post_loop_vertex),)
+    return rules
 
-    def derive_grammar(self):
-        """
-        Derive a dictionary mapping vertices to lists of symbol lists.
-        The symbols are either edges (terminal symbols) or vertices (non-terminal symbols).
-        """
-        # print("constructing context free grammar from scfg")
-        final_map = {}
-        for vertex in self.vertices:
-            # print(vertex)
-            # check for the type of vertex
-            if len(vertex.edges) == 0:
 
-                # control flow can end at this vertex - the rule for it should just generate the empty string
-                final_map[vertex] = [[None]]
-
-            elif not (vertex._name_changed in [["conditional"], ["loop"], ["try-catch"], ["post-conditional"],
-                                               ["post-loop"], ["post-try-catch"]]):
-
-                # a normal vertex, but we care about what it leads to since this determines the "special" structure of rules we generate
-
-                # print(vertex._name_changed)
-                # we handle conditionals and try-catches together at the moment, because they have similar structure
-                if not (vertex.edges[0]._target_state._name_changed in [["conditional"], ["try-catch"]]):
-
-                    # check which vertices this leads to
-
-                    if vertex.edges[0]._target_state._name_changed in [["post-conditional"], ["post-try-catch"]]:
-                        final_map[vertex] = [[vertex.edges[0]]]
-                    elif any(map(lambda edge: edge._target_state._name_changed == ["post-loop"], vertex.edges)):
-                        # we have to deal with some branching
-                        reloop_edge = \
-                            list(filter(lambda edge: edge._target_state._name_changed == ["loop"], vertex.edges))[0]
-                        loop_skip_edge = \
-                            list(filter(lambda edge: edge._target_state._name_changed != ["loop"], vertex.edges))[0]
-                        final_map[vertex] = [[reloop_edge, reloop_edge._target_state], [loop_skip_edge]]
-                    elif vertex.edges[0]._target_state._name_changed == ["loop"]:
-                        post_loop_vertex = list(filter(
-                            lambda edge: edge._target_state._name_changed == ["post-loop"],
-                            vertex.edges[0]._target_state.edges
-                        ))[0]._target_state
-                        final_map[vertex] = [[vertex.edges[0], vertex.edges[0]._target_state, post_loop_vertex]]
-                    else:
-                        # normal vertex that isn't followed by any special structure
-                        if vertex.edges[0]._target_state._name_changed in [["post-conditional"], ["post-loop"],
-                                                                           ["post-try-catch"]]:
-                            final_map[vertex] = [[vertex.edges[0]]]
-                        else:
-                            final_map[vertex] = [[vertex.edges[0], vertex.edges[0]._target_state]]
-
-                elif vertex.edges[0]._target_state._name_changed == ["conditional"]:
-
-                    # get the edge that leads to the end of the conditional
-                    post_conditional_vertex = vertex.edges[0]._target_state.post_conditional_vertex
-                    if post_conditional_vertex:
-                        final_map[vertex] = [[vertex.edges[0], vertex.edges[0]._target_state, post_conditional_vertex]]
-                    else:
-                        final_map[vertex] = [[vertex.edges[0], vertex.edges[0]._target_state]]
-
-                elif vertex.edges[0]._target_state._name_changed == ["try-catch"]:
-
-                    # get the edge that leads to the end of the try-catch
-                    post_try_catch_vertex = vertex.edges[0]._target_state.post_try_catch_vertex
-                    if post_try_catch_vertex:
-                        final_map[vertex] = [[vertex.edges[0], vertex.edges[0]._target_state, post_try_catch_vertex]]
-                    else:
-                        final_map[vertex] = [[vertex.edges[0], vertex.edges[0]._target_state]]
-
-            elif vertex._name_changed == ["loop"]:
-
-                # find the loop-skip edge
-                loop_skip_edge = \
-                    list(filter(lambda edge: edge._target_state._name_changed == ["post-loop"], vertex.edges))[0]
-                final_map[vertex] = [[loop_skip_edge]]
-                loop_entry_edge = \
-                    list(filter(lambda edge: edge._target_state._name_changed != ["post-loop"], vertex.edges))[
-                        0]
-                final_map[vertex].append([loop_entry_edge, loop_entry_edge._target_state])
-
-
-            elif vertex._name_changed in [["conditional"], ["try-catch"]]:
-
-                final_map[vertex] = []
-                for edge in vertex.edges:
-                    # we check whether we're looking at an edge that leads straight past the conditional
-                    # and directly to the post-conditional vertex
-                    if edge._target_state._name_changed == ["post-conditional"]:
-                        final_map[vertex].append([edge])
-                    else:
-                        final_map[vertex].append([edge, edge._target_state])
-
-            elif vertex._name_changed == ["post-conditional"]:
+def _statement_to_conditional_rules(edges, first_edge):
+    # get the edge that leads to the end of the conditional
+    first_target = first_edge._target_state
+    post_conditional_vertex = first_target.post_conditional_vertex
+    if post_conditional_vertex:
+        return ((first_edge, first_target, post_conditional_vertex),)
+    else:
+        return ((first_edge, first_target),)
 
-                # check whether we're inside a loop
-                if vertex.edges[0]._target_state._name_changed == ["loop"]:
-                    # if we're inside a loop, then we need to include the post-loop edge
-                    final_map[vertex] = [
-                        [vertex.edges[0], vertex.edges[0]._target_state],
-                        [vertex.edges[1]]
-                    ]
-                elif vertex.edges[0]._target_state._name_changed == ["post-conditional"]:
-                    final_map[vertex] = [[vertex.edges[0]]]
-                else:
-                    final_map[vertex] = [[vertex.edges[0], vertex.edges[0]._target_state]]
 
-            else:
+def _statement_to_try_catch_rules(edges, first_edge):
+    # get the edge that leads to the end of the try-catch
+    first_target = first_edge._target_state
+    post_try_catch_vertex = first_target.post_try_catch_vertex
+    if post_try_catch_vertex:
+        return ((first_edge, first_target, post_try_catch_vertex),)
+    else:
+        return ((first_edge, first_target),)
+
+
+def _loop_rules(edges, first_edge):
+    # find the loop-skip edge and the edge entering the loop body in one pass
+    loop_skip_edge = None
+    loop_entry_edge = None
+    for edge in edges:
+        if edge._target_category == _POST_LOOP_VERTEX:
+            if loop_skip_edge is None:
+                loop_skip_edge = edge
+        elif loop_entry_edge is None:
+            loop_entry_edge = edge
+    return ((loop_skip_edge,), (loop_entry_edge, loop_entry_edge._target_state))
+
+
+def _branching_rules(edges, first_edge):
+    rules = []
+    for edge in edges:
+        # we check whether we're looking at an edge that leads straight past the conditional
+        # and directly to the post-conditional vertex
+        if edge._target_category == _POST_CONDITIONAL_VERTEX:
+            rules.append((edge,))
+        else:
+            rules.append((edge, edge._target_state))
+    return tuple(rules)
 
-                if vertex.edges[0]._target_state._name_changed in [["post-conditional"], ["post-loop"],
-                                                                   ["post-try-catch"]]:
-                    final_map[vertex] = [[vertex.edges[0]]]
-                else:
-                    final_map[vertex] = [[vertex.edges[0], vertex.edges[0]._target_state]]
 
-        # print(final_map[vertex])
+def _post_conditional_to_loop_rules(edges, first_edge):
+    # if we're inside a loop, then we need to include the post-loop edge
+    return (
+        (first_edge, first_edge._target_state),
+        (edges[1],)
+    )
 
-        return final_map
 
-    def next_calls(self, vertex, function, calls=[], marked_vertices=[]):
-        """
-        Given a point (vertex or edge), find the set of next edges that model calls to function.
-        """
-        if not (vertex in marked_vertices):
-            marked_vertices.append(vertex)
-            edges = vertex.edges
-            for edge in edges:
-                if ((type(edge._instruction) is ast.Expr
-                     and hasattr(edge._instruction.value, "func")
-                     and function in get_function_name_strings(edge._instruction.value))
-                        or
-                        (type(edge._instruction) is ast.Assign
-                         and type(edge._instruction.value) is ast.Call and function in get_function_name_strings(
-                                    edge._instruction.value))):
-                    calls.append(edge)
+def _build_grammar_rule_functions():
+    """
+    Build the map from (category of vertex, category of the first vertex it leads to)
+    to the function giving the rules for that vertex.
+    """
+    all_categories = range(_POST_WHILE_VERTEX + 1)
+    rule_functions = {}
+    for own_category in all_categories:
+        for first_category in all_categories:
+            if not (1 << own_category & _CONTROL_FLOW_CATEGORY_MASK):
+                # a normal vertex, but we care about what it leads to since this determines
+                # the "special" structure of rules we generate
+                # we handle conditionals and try-catches in the same way at the moment,
+                # because they have similar structure
+                if first_category == _CONDITIONAL_VERTEX:
+                    rule_function = _statement_to_conditional_rules
+                elif first_category == _TRY_CATCH_VERTEX:
+                    rule_function = _statement_to_try_catch_rules
+                elif 1 << first_category & _SKIPPED_AFTER_STATEMENT_CATEGORY_MASK:
+                    rule_function = _skip_rules
+                elif first_category == _LOOP_VERTEX:
+                    rule_function = _statement_to_loop_rules
                 else:
-                    # this edge is not what we're looking for
-                    # so traverse this branch further
-                    self.next_calls(edge._target_state, function, calls, marked_vertices)
-        else:
-            pass
+                    rule_function = _statement_to_statement_rules
+            elif own_category == _LOOP_VERTEX:
+                rule_function = _loop_rules
+            elif own_category == _CONDITIONAL_VERTEX or own_category == _TRY_CATCH_VERTEX:
+                rule_function = _branching_rules
+            elif own_category == _POST_CONDITIONAL_VERTEX:
+                # check whether we're inside a loop
+                if first_category == _LOOP_VERTEX:
+                    rule_function = _post_conditional_to_loop_rules
+                elif first_category == _POST_CONDITIONAL_VERTEX:
+                    rule_function = _skip_rules
+                else:
+                    rule_function = _plain_rules
+            elif 1 << first_category & _POST_STRUCTURE_CATEGORY_MASK:
+                rule_function = _skip_rules
+            else:
+                rule_function = _plain_rules
+            rule_functions[(own_category, first_category)] = rule_function
+    return rule_functions
+
+
+_GRAMMAR_RULE_FUNCTIONS = _build_grammar_rule_functions()
+
+
+# map each kind of statement to the CFG method that constructs its part of the graph.
+# the plain functions are taken from the class dictionary, so that calling a handler
+# doesn't go through an unbound method (and its check on the type of self) on Python 2
+_cfg_methods = vars(CFG)
+_STATEMENT_HANDLERS = {
+    ast.Assign: _cfg_methods["_handle_simple"],
+    ast.Expr: _cfg_methods["_handle_expr"],
+    ast.Pass: _cfg_methods["_handle_simple"],
+    ast.Return: _cfg_methods["_handle_simple"],
+    ast.Raise: _cfg_methods["_handle_simple"],
+    ast.Break: _cfg_methods["_handle_break"],
+    ast.Continue: _cfg_methods["_handle_continue"],
+    ast.If: _cfg_methods["_handle_if"],
+    _TRY_STATEMENT_TYPE: _cfg_methods["_handle_try"],
+    ast.For: _cfg_methods["_handle_for"],
+    ast.While: _cfg_methods["_handle_while"],
+}
+del _cfg_methods
+
+
+# string representations of the kinds of expression and instruction that have special treatment
+_EXPRESSION_STRING_FUNCTIONS = {
+    ast.Num: lambda expression: str(expression.n)
+}
+
+_INSTRUCTION_STRING_FUNCTIONS = {
+    ast.Assign: lambda instruction: "%s = %s" % (get_attr_name_string(instruction.targets[0]),
+                                                 expression_as_string(instruction.value)),
+    ast.Expr: lambda instruction: "%s()" % get_function_name_strings(instruction.value)
+}
 
 
 def expression_as_string(expression):
-    if type(expression) is ast.Num:
-        return str(expression.n)
-    else:
-        return str(expression)
+    return _EXPRESSION_STRING_FUNCTIONS.get(type(expression), str)(expression)
 
 
 def instruction_to_string(instruction):
-    if type(instruction) is ast.Assign:
-        return "%s = %s" % (get_attr_name_string(instruction.targets[0]), expression_as_string(instruction.value))
-    elif type(instruction) is ast.Expr:
-        return "%s()" % get_function_name_strings(instruction.value)
+    string_function = _INSTRUCTION_STRING_FUNCTIONS.get(type(instruction))
+    if string_function:
+        return string_function(instruction)
@@ -5,25 +5,57 @@ import datetime
 import json
 import os
 import pickle
+import random
+import re
 import threading
 import flask
 import traceback
 import requests
 import base64
-
-from Queue import Queue
+import time
+
+from collections import defaultdict, deque, namedtuple
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    # Python 3
+    from queue import Empty, Queue
 import requests
+from requests.adapters import HTTPAdapter
 from VyPR.SCFG.construction import CFGEdge, CFGVertex
 from VyPR.QueryBuilding import *
 from VyPR.monitor_synthesis import formula_tree
 from VyPR.verdict_reports import VerdictReport
 
 VERDICT_SERVER_URL = None
+# urls of the verdict server's endpoints, worked out once the verdict server url is known
+INSERT_FUNCTION_CALL_DATA_URL = None
+REGISTER_VERDICTS_URL = None
+INSERT_TEST_DATA_URL = None
+GET_PROPERTY_FROM_HASH_URL = None
 VYPR_OUTPUT_VERBOSE = False
 PROJECT_ROOT = None
+# the directory that instrumentation writes binding spaces to, worked out once the project root is known
+BINDING_SPACES_DIR = None
 TEST_FRAMEWORK = 'no'
 TEST_DIR = ''
-
+# the maximum number of events the consumption thread takes from the queue at once
+CONSUMPTION_BATCH_SIZE = 256
+# the maximum number of events an instrumented thread keeps before putting them on the consumption queue,
+# and the kinds of property-specific instrument whose events are kept (anything else is put on the queue
+# straight away, along with the events kept before it)
+EVENT_BUFFER_SIZE = 64
+BUFFERED_INSTRUMENT_TYPES = ("trigger", "path", "instrument")
+# the number of threads sending function call and verdict data to the verdict server,
+# and the number of function calls whose data can be waiting to be sent before the consumption thread blocks
+SENDER_THREADS = 4
+SENDER_QUEUE_SIZE = 1024
+
+# all communication with the verdict server goes through one session,
+# so connections are kept alive and reused instead of being opened for every request
+http_session = requests.Session()
+http_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
 
 
 class MonitoringLog(object):
@@ -59,6 +91,53 @@ class MonitoringLog(object):
 
 
 
+class ConsumptionQueue(object):
+    """
+    Queue of events sent by instruments, consumed by the monitoring thread.
+    Appending to and popping from either end of a deque are atomic, so instruments in the service's threads
+    never have to acquire a lock to send an event.  Since there's only ever one consumer, it polls
+    when the queue is empty rather than waiting on a condition variable that every producer would have to notify.
+    The time between polls starts small, so bursts of events are picked up quickly, and backs off
+    (with some jitter) while the queue stays empty, so an idle consumer barely uses the CPU.
+    """
+
+    # bounds on how long the consumer sleeps between checks of an empty queue
+    MIN_POLL_INTERVAL = 0.001
+    MAX_POLL_INTERVAL = 0.1
+
+    def __init__(self):
+        self._events = deque()
+        # putting an event is just the deque's append, so sending an event from an instrument
+        # doesn't go through a Python-level method call
+        self.put = self._events.append
+
+    def get_nowait(self):
+        try:
+            return self._events.popleft()
+        except IndexError:
+            raise Empty
+
+    def get(self, timeout=None):
+        """
+        Wait for up to timeout seconds (or forever, if no timeout is given) for an event.
+        """
+        give_up_time = None if timeout is None else time.time() + timeout
+        poll_interval = self.MIN_POLL_INTERVAL
+        while True:
+            try:
+                return self._events.popleft()
+            except IndexError:
+                if not (give_up_time is None):
+                    remaining_time = give_up_time - time.time()
+                    if remaining_time <= 0:
+                        raise Empty
+                    time.sleep(min(poll_interval, remaining_time))
+                else:
+                    time.sleep(poll_interval)
+                poll_interval = min(self.MAX_POLL_INTERVAL,
+                                    poll_interval * 2 + random.uniform(0, poll_interval * 0.1))
+
+
 def to_timestamp(obj):
     if type(obj) is datetime.datetime:
         return obj.isoformat()
@@ -68,26 +147,176 @@ def to_timestamp(obj):
         return obj
 
 
+class VerdictJSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder that serialises datetime and timedelta objects using to_timestamp.
+    """
+
+    def default(self, obj):
+        return to_timestamp(obj)
+
+
+# one encoder is used for all verdict data that's sent
+verdict_json_encoder = VerdictJSONEncoder()
+
+# data sent to and received from the verdict server is encoded and decoded with a faster json library
+# if one is installed - orjson for both directions, or ujson for decoding
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# ntplib is only needed when an NTP server is configured
+try:
+    import ntplib
+except ImportError:
+    ntplib = None
+
+if not (orjson is None):
+    def dumps_json(obj):
+        # verdict data has maps with integer keys
+        return orjson.dumps(obj, default=to_timestamp, option=orjson.OPT_NON_STR_KEYS)
+
+    loads_json = orjson.loads
+else:
+    dumps_json = verdict_json_encoder.encode
+    loads_json = json.loads if ujson is None else ujson.loads
+
+
+# information about an atom that the trigger branch of the consumption thread needs when it copies
+# observations from one monitor to another.  bind_positions holds a pair (sub index, position of the
+# base variable in the property's bind variables) for each base variable of the atom.
+# relevant_sub_indices holds, for each bind variable index, the sub indices whose base variables come
+# before that bind variable.
+AtomMeta = namedtuple("AtomMeta", ["is_lnot", "is_mixed", "base_vars", "bind_positions", "relevant_sub_indices"])
+
+# map from (id of formula structure, atom index) to AtomMeta
+_atom_meta_cache = {}
+
+
+def _atom_meta(formula_structure, atom_index):
+    """
+    Get the AtomMeta for the atom at atom_index in formula_structure, computing it the first time.
+    """
+    key = (id(formula_structure), atom_index)
+    try:
+        return _atom_meta_cache[key]
+    except KeyError:
+        pass
+
+    atom = formula_structure._formula_atoms[atom_index]
+    if type(atom) is formula_tree.LogicalNot:
+        meta = AtomMeta(True, False, (), (), ())
+    else:
+        is_mixed = formula_tree.is_mixed_atom(atom)
+        # for mixed atoms, get_base_variable gives a list
+        base_vars = tuple(get_base_variable(atom)) if is_mixed else (get_base_variable(atom),)
+        bind_positions = tuple([(base_vars.index(var), formula_structure._bind_variables.index(var))
+                                for var in base_vars])
+        relevant_sub_indices = tuple([
+            tuple([sub_index for (sub_index, position) in bind_positions if position < bind_variable_index])
+            for bind_variable_index in range(len(formula_structure._bind_variables))
+        ])
+        meta = AtomMeta(False, is_mixed, base_vars, bind_positions, relevant_sub_indices)
+
+    _atom_meta_cache[key] = meta
+    return meta
+
+
+# flask.g is a proxy that looks up the current context on every attribute access,
+# so the hooks VyPR adds to flask get the object behind it once, from the top of the context stack
+try:
+    from flask import _app_ctx_stack
+
+    def current_flask_g():
+        return _app_ctx_stack.top.g
+except ImportError:
+    # versions of flask without the stack
+    def current_flask_g():
+        return flask.g._get_current_object()
+
+
+# VyPR's end points, added to a flask app by Verification.initialise - they act on vypr_instance,
+# the Verification object that added them
+vypr_blueprint = flask.Blueprint("vypr", __name__)
+vypr_instance = None
+
+
+def request_needs_vypr():
+    """
+    Requests for static files and for VyPR's own end points don't run any instrumented code,
+    so the hooks VyPR adds to flask don't need to do anything for them.
+    """
+    endpoint = flask.request.endpoint
+    if endpoint is None:
+        # no route matched, but an error handler may still be instrumented
+        return True
+    return not (endpoint == "static" or endpoint.endswith(".static") or endpoint.startswith("vypr."))
+
+
+# the safe exit end point
+@vypr_blueprint.route("/stop-monitoring/", endpoint="stop")
+def endpoint_stop_monitoring():
+    # send end-monitoring message
+    vypr_instance.end_monitoring()
+    # wait for the thread to end
+    vypr_instance.consumption_thread.join()
+    return "VyPR monitoring thread exited.  The server must be restarted to turn monitoring back on.\n"
+
+
+@vypr_blueprint.route("/pause-monitoring/", endpoint="pause")
+def endpoint_pause_monitoring():
+    vypr_instance.pause_monitoring()
+    return "VyPR monitoring paused - thread is still running.\n"
+
+
+@vypr_blueprint.route("/resume-monitoring/", endpoint="resume")
+def endpoint_resume_monitoring():
+    vypr_instance.resume_monitoring()
+    return "VyPR monitoring resumed.\n"
+
+
 # set up logging variable
 vypr_logger = None
 
 
-def vypr_output(string):
+def vypr_output(string, *args):
+    """
+    Log string if verbose output is turned on.  If arguments are given, string is a format string
+    that they're substituted into, so the formatting is only done when the message is actually logged.
+    """
     global vypr_logger
     if VYPR_OUTPUT_VERBOSE:
-        vypr_logger.log(string)
+        vypr_logger.log(string % args if args else string)
+
+
+def set_verdict_server_urls(verdict_server_url):
+    """
+    Work out the urls of the verdict server endpoints we use from the verdict server's url.
+    Endpoints are always relative to the whole url (even if it doesn't end in a slash).
+    """
+    global INSERT_FUNCTION_CALL_DATA_URL, REGISTER_VERDICTS_URL, INSERT_TEST_DATA_URL, GET_PROPERTY_FROM_HASH_URL
+    if not verdict_server_url.endswith("/"):
+        verdict_server_url += "/"
+    INSERT_FUNCTION_CALL_DATA_URL = verdict_server_url + "insert_function_call_data/"
+    REGISTER_VERDICTS_URL = verdict_server_url + "register_verdicts/"
+    INSERT_TEST_DATA_URL = verdict_server_url + "insert_test_data/"
+    GET_PROPERTY_FROM_HASH_URL = verdict_server_url + "get_property_from_hash/%s/"
 
 
 def send_function_call_data(function_name, time_of_call, end_time_of_call, program_path, transaction_time):
     """
     Send a function call to the verdict server.
     """
-    global VERDICT_SERVER_URL
     vypr_output("Sending function call data to server...")
 
     # first, send function call data - this will also insert program path data
-    vypr_output("Function start time was %s" % time_of_call)
-    vypr_output("Function end time was %s" % end_time_of_call)
+    vypr_output("Function start time was %s", time_of_call)
+    vypr_output("Function end time was %s", end_time_of_call)
 
     call_data = {
         "transaction_time": transaction_time.isoformat(),
@@ -96,9 +325,9 @@ def send_function_call_data(function_name, time_of_call, end_time_of_call, progr
         "function_name": function_name,
         "program_path": program_path
     }
-    insertion_result = json.loads(requests.post(
-        os.path.join(VERDICT_SERVER_URL, "insert_function_call_data/"),
-        data=json.dumps(call_data)
+    insertion_result = loads_json(http_session.post(
+        INSERT_FUNCTION_CALL_DATA_URL,
+        data=dumps_json(call_data)
     ).text)
 
     vypr_output("Function call data sent.")
@@ -110,33 +339,22 @@ def send_verdict_report(verdict_report, property_hash, function_id, function_cal
     """
     Send verdict data for a given function call.
     """
-    global VERDICT_SERVER_URL
     verdicts = verdict_report.get_final_verdict_report()
     vypr_output("Sending verdicts to server...")
 
     # second, send verdict data - all data in one request
     # for this, we first build the structure
     # that we'll send over HTTP
-    verdict_dict_list = []
-    for bind_space_index in verdicts.keys():
-        verdict_list = verdicts[bind_space_index]
-        for verdict in verdict_list:
+    # datetime objects in the verdicts are dealt with by the json encoder
+    verdict_dict_list = [
+        {"bind_space_index": bind_space_index, "verdict": verdict}
+        for (bind_space_index, verdict_list) in verdicts.items()
+        for verdict in verdict_list
+    ]
+    if VYPR_OUTPUT_VERBOSE:
+        for verdict_dict in verdict_dict_list:
             vypr_output("Sending verdict")
-            vypr_output(verdict)
-            # remember to deal with datetime objects in json serialisation
-            verdict_dict = {
-                "bind_space_index": bind_space_index,
-                "verdict": [
-                    verdict[0],
-                    verdict[1].isoformat(),
-                    verdict[2],
-                    verdict[3],
-                    verdict[4],
-                    verdict[5],
-                    verdict[6]
-                ]
-            }
-            verdict_dict_list.append(verdict_dict)
+            vypr_output(verdict_dict["verdict"])
 
     request_body_dict = {
         "function_call_id": function_call_id,
@@ -147,8 +365,8 @@ def send_verdict_report(verdict_report, property_hash, function_id, function_cal
 
     # send request
     try:
-        requests.post(os.path.join(VERDICT_SERVER_URL, "register_verdicts/"),
-                      data=json.dumps(request_body_dict, default=to_timestamp))
+        http_session.post(REGISTER_VERDICTS_URL,
+                          data=dumps_json(request_body_dict))
     except Exception as e:
         vypr_output(
             "Something went wrong when sending verdict information to the verdict server.  The verdict information we "
@@ -159,404 +377,497 @@ def send_verdict_report(verdict_report, property_hash, function_id, function_cal
     vypr_output("Verdicts sent.")
 
 
+def send_function_call_and_verdicts(function_name, time_of_call, end_time_of_call, program_path,
+                                    transaction_time, property_verdict_reports):
+    """
+    Send a function call to the verdict server, followed by the verdict report for each
+    (property hash, verdict report) pair in property_verdict_reports.
+    """
+    insertion_data = send_function_call_data(
+        function_name,
+        time_of_call,
+        end_time_of_call,
+        program_path,
+        transaction_time
+    )
+    for (property_hash, verdict_report) in property_verdict_reports:
+        send_verdict_report(
+            verdict_report,
+            property_hash,
+            insertion_data["function_id"],
+            insertion_data["function_call_id"]
+        )
 
 
-def consumption_thread_function(verification_obj):
-    # the web service has to be considered as running forever, so the monitoring loop for now should also run forever
-    # this needs to be changed for a clean exit
-    INACTIVE_MONITORING = False
-    transaction = -1
-    continue_monitoring = True
-    while continue_monitoring:
+# data to be sent to the verdict server is put here by the consumption thread,
+# so it doesn't have to wait for the server to respond
+outbound_queue = Queue(maxsize=SENDER_QUEUE_SIZE)
+sender_threads = []
+sender_threads_lock = threading.Lock()
 
-        # take top element from the queue
+
+def sender_thread_function():
+    while True:
+        arguments = outbound_queue.get()
         try:
-            top_pair = verification_obj.consumption_queue.get(timeout=1)
-            ## In case of flask testing
+            send_function_call_and_verdicts(*arguments)
         except:
-            # Changing flag to false here because in normal testing, end-monitoring does not change to False.
-            # If exception is raised we just terminate the monitoring
-            continue
+            vypr_output("Something went wrong when sending function call data to the verdict server.")
+            vypr_output(traceback.format_exc())
+        finally:
+            outbound_queue.task_done()
 
 
-        if top_pair[0] == "end-monitoring":
-            # return from the monitoring function to end the monitoring thread
-            vypr_output("Returning from monitoring thread.")
-            continue_monitoring = False
-            continue
+def start_sender_threads():
+    """
+    Start the threads that send data from outbound_queue, if they haven't been started already.
+    """
+    with sender_threads_lock:
+        if sender_threads:
+            return
+        for n in range(SENDER_THREADS):
+            sender_thread = threading.Thread(target=sender_thread_function, name="vypr-sender-%i" % n)
+            # the threads wait on the queue forever, so they mustn't keep the process alive
+            sender_thread.daemon = True
+            sender_thread.start()
+            sender_threads.append(sender_thread)
 
-        # if monitoring is inactive, we do nothing with what we consume unless it's a resume message
-        if INACTIVE_MONITORING:
-            if top_pair[0] == "inactive-monitoring-stop":
-                # return from the monitoring function to end the monitoring thread
-                vypr_output("Restarting monitoring.  Monitoring thread will still be alive.")
-                INACTIVE_MONITORING = False
-            continue
+
+def process_function_event(top_pair, function_to_maps, transaction):
+    """
+    Process the start or end of a call of a monitored function.
+    """
+    property_hash_list = top_pair[1]
+    function_name = top_pair[2]
+    scope_event = top_pair[3]
+    fn_maps = function_to_maps[function_name]
+    if scope_event == "end":
+
+        # first, send the function call data independently of any property
+        # the latest time of call and program path are the same everywhere
+        any_maps = next(iter(fn_maps.values()))
+        latest_time_of_call = any_maps.latest_time_of_call
+        program_path = any_maps.program_path
+
+
+        if 'yes' in TEST_FRAMEWORK :
+            transaction_time = transaction
         else:
-            if top_pair[0] == "inactive-monitoring-start":
-                # return from the monitoring function to end the monitoring thread
-                vypr_output("Pausing monitoring.  Monitoring thread will still be alive.")
-                # turn on inactive monitoring
-                INACTIVE_MONITORING = True
-                # skip to the next iteration of the consumption loop
-                continue
-        # if inactive monitoring is off (so monitoring is running), process what we consumed
+            transaction_time = top_pair[3]
 
+        # now handle the verdict data we have for each property
+        property_verdict_reports = []
+        for property_hash in property_hash_list:
 
-        if top_pair[0] == "test_transaction":
-            transaction = top_pair[1]
-            vypr_output("Test Transaction >> %s" %str(top_pair))
-            continue
+            maps = fn_maps[property_hash]
+            static_qd_to_monitors = maps.static_qd_to_monitors
+            verdict_report = maps.verdict_report
+
+            vypr_output("*" * 50)
+
+            # before resetting the qd -> monitor map, go through it to find monitors
+            # that reached a verdict, and register those in the verdict report
+
+            for static_qd_index in static_qd_to_monitors:
+                for monitor in static_qd_to_monitors[static_qd_index]:
+                    # check if the monitor has a collapsing atom - only then do we register a verdict
+                    if monitor.collapsing_atom_index is not None:
+                        verdict_report.add_verdict(
+                            static_qd_index,
+                            monitor._formula.verdict,
+                            monitor.atom_to_observation,
+                            monitor.atom_to_program_path,
+                            monitor.collapsing_atom_index,
+                            monitor.collapsing_atom_sub_index,
+                            monitor.atom_to_state_dict
+                        )
+
+            # reset the monitors
+            maps.static_qd_to_monitors = defaultdict(list)
+
+            # hand the verdict report over to be sent, and give the maps a fresh one
+            property_verdict_reports.append((property_hash, verdict_report))
+            maps.verdict_report = VerdictReport()
 
+            # reset the function start time for the next time
+            maps.latest_time_of_call = None
 
-        vypr_output("Consuming: %s" % str(top_pair))
+        # the function call and verdict data are sent by the sender threads
+        outbound_queue.put((
+            function_name,
+            latest_time_of_call,
+            top_pair[-1],
+            list(program_path),
+            transaction_time,
+            property_verdict_reports
+        ))
 
-        first_element = top_pair[0]
+    elif scope_event == "start":
+        vypr_output("Function '%s' has started.", function_name)
 
-        if first_element == "function":
+        for property_hash in property_hash_list:
+            # reset anything that might have been left over from the previous call,
+            # especially if an unhandled exception caused the function to end without
+            # vypr instruments sending an end signal
 
-            # we have a function start/end instrument
+            maps = fn_maps[property_hash]
+            maps.static_qd_to_monitors = defaultdict(list)
+            maps.verdict_report.reset()
 
-            property_hash_list = top_pair[1]
-            function_name = top_pair[2]
-            scope_event = top_pair[3]
-            if scope_event == "end":
+            # remember when the function call started
+            maps.latest_time_of_call = top_pair[4]
 
-                # first, send the function call data independently of any property
-                # the latest time of call and program path are the same everywhere
-                latest_time_of_call = verification_obj.function_to_maps[function_name][
-                    verification_obj.function_to_maps[function_name].keys()[0]
-                ].latest_time_of_call
-                program_path = verification_obj.function_to_maps[function_name][
-                    verification_obj.function_to_maps[function_name].keys()[0]
-                ].program_path
+        vypr_output("Set start time to %s", maps.latest_time_of_call)
+
+        # reset the program path
+        maps.program_path = []
+
+        vypr_output("*" * 50)
+
+
+def process_trigger(top_pair, maps):
+    """
+    Process a trigger instrument, which instantiates or updates monitors.
+    """
+    static_qd_to_monitors = maps.static_qd_to_monitors
+    formula_structure = maps.formula_structure
+    atoms = formula_structure._formula_atoms
 
+    static_qd_index = top_pair[2]
+    bind_variable_index = top_pair[3]
 
-                if 'yes' in TEST_FRAMEWORK :
-                    transaction_time = transaction
+    # logging on the consumption thread's per-event paths is guarded so it costs nothing when it's turned off
+    if VYPR_OUTPUT_VERBOSE:
+        vypr_output("Processing trigger - dealing with monitor instantiation")
+        vypr_output("Trigger is for bind variable %i", bind_variable_index)
+    if bind_variable_index == 0:
+        vypr_output("Instantiating new, clean monitor")
+        # we've encountered a trigger for the first bind variable, so we simply instantiate a new monitor
+        new_monitor = formula_tree.new_monitor(formula_structure.get_formula_instance())
+        static_qd_to_monitors[static_qd_index].append(new_monitor)
+    else:
+        vypr_output("Processing existing monitors")
+        # we look at the monitors' timestamps, and decide whether to generate a new monitor
+        # and copy over existing information, or update timestamps of existing monitors
+        new_monitors = []
+        subsequences_processed = []
+        # bind what the loops below use to locals
+        lnot = formula_tree.lnot
+        new_monitor_from_formula = formula_tree.new_monitor
+        get_formula_instance = formula_structure.get_formula_instance
+        # every monitor affected by this trigger gets the same timestamp for this bind variable
+        trigger_time = datetime.datetime.now()
+        for monitor in static_qd_to_monitors[static_qd_index]:
+            instantiation_time = monitor._monitor_instantiation_time
+            # check if the monitor's timestamp sequence includes a timestamp for this bind variable
+            if VYPR_OUTPUT_VERBOSE:
+                vypr_output("  Processing monitor with timestamp sequence %s", instantiation_time)
+            if len(instantiation_time) == bind_variable_index + 1:
+                instantiation_subsequence = instantiation_time[:bind_variable_index]
+                if instantiation_subsequence in subsequences_processed:
+                    # the same subsequence might have been copied and extended multiple times
+                    # we only care about one
+                    continue
                 else:
-                    transaction_time = top_pair[3]
-
-                insertion_data = send_function_call_data(
-                    function_name,
-                    latest_time_of_call,
-                    top_pair[-1],
-                    program_path,
-                    transaction_time
-                )
+                    subsequences_processed.append(instantiation_subsequence)
+                    # construct new monitor
+                    vypr_output("    Instantiating new monitor with modified timestamp sequence")
+                    # instantiate a new monitor using the timestamp subsequence excluding the current bind
+                    # variable and copy over all observation, path and state information
+
+                    updated_instantiation_time = instantiation_subsequence + (trigger_time,)
+                    new_monitor = new_monitor_from_formula(get_formula_instance())
+                    new_monitors.append(new_monitor)
+
+                    # copy timestamp sequence, observation, path and state information
+                    new_monitor._monitor_instantiation_time = updated_instantiation_time
+
+                    monitor_state = monitor._state._state
+                    atom_to_observation = monitor.atom_to_observation
+                    atom_to_program_path = monitor.atom_to_program_path
+                    atom_to_state_dict = monitor.atom_to_state_dict
+                    new_atom_to_observation = new_monitor.atom_to_observation
+                    new_atom_to_program_path = new_monitor.atom_to_program_path
+                    new_atom_to_state_dict = new_monitor.atom_to_state_dict
+
+                    # iterate through the observations stored by the previous monitor
+                    # for bind variables before the current one and use them to update the new monitor
+                    for atom_index in monitor_state:
+
+                        atom = atoms[atom_index]
+                        meta = _atom_meta(formula_structure, atom_index)
+
+                        if not meta.is_lnot:
+
+                            # the copy we do for the information related to the atom
+                            # depends on whether the atom is mixed or not
+
+                            if meta.is_mixed:
+
+                                # copy over observation, program path and state information for the
+                                # sub indices whose base variables had positions less than the current
+                                # variable index - relevant_sub_indices can contain at most 0 and 1.
+                                relevant_sub_indices = meta.relevant_sub_indices[bind_variable_index]
+                                if relevant_sub_indices:
+                                    observations = atom_to_observation[atom_index]
+                                    program_paths = atom_to_program_path[atom_index]
+                                    state_dicts = atom_to_state_dict[atom_index]
+                                    # set up keys in new monitor state if they aren't already there
+                                    new_atom_to_observation.setdefault(atom_index, {}).update(
+                                        [(sub_index, observations[sub_index])
+                                         for sub_index in relevant_sub_indices])
+                                    new_atom_to_program_path.setdefault(atom_index, {}).update(
+                                        [(sub_index, program_paths[sub_index])
+                                         for sub_index in relevant_sub_indices])
+                                    new_atom_to_state_dict.setdefault(atom_index, {}).update(
+                                        [(sub_index, state_dicts[sub_index])
+                                         for sub_index in relevant_sub_indices])
+
+                                    # update the state of the monitor - if this makes it reach a verdict,
+                                    # the last sub index copied is the collapsing one
+                                    new_monitor.check_atom_truth_value(atom, atom_index, relevant_sub_indices[-1])
+                            else:
 
-                # now handle the verdict data we have for each property
-                for property_hash in property_hash_list:
+                                # the atom is not mixed, so copying over information is simpler
 
-                    maps = verification_obj.function_to_maps[function_name][property_hash]
-                    static_qd_to_monitors = maps.static_qd_to_monitors
-                    verdict_report = maps.verdict_report
+                                if (meta.relevant_sub_indices[bind_variable_index]
+                                        and not (monitor_state[atom] is None)):
 
-                    vypr_output("*" * 50)
+                                    # decide how to update the new monitor based on the existing monitor's truth
+                                    # value for it
+                                    truth_value = monitor_state[atom_index]
+                                    if truth_value == True:
+                                        new_monitor.check_optimised(atom)
+                                    elif truth_value == False:
+                                        new_monitor.check_optimised(lnot(atom))
 
-                    # before resetting the qd -> monitor map, go through it to find monitors
-                    # that reached a verdict, and register those in the verdict report
+                                    # copy over observation, program path and state information
+                                    new_atom_to_observation.setdefault(atom_index, {})[0] = \
+                                        atom_to_observation[atom_index][0]
+                                    new_atom_to_program_path.setdefault(atom_index, {})[0] = \
+                                        atom_to_program_path[atom_index][0]
+                                    new_atom_to_state_dict.setdefault(atom_index, {})[0] = \
+                                        atom_to_state_dict[atom_index][0]
 
-                    for static_qd_index in static_qd_to_monitors:
-                        for monitor in static_qd_to_monitors[static_qd_index]:
-                            # check if the monitor has a collapsing atom - only then do we register a verdict
-                            if monitor.collapsing_atom_index is not None:
-                                verdict_report.add_verdict(
-                                    static_qd_index,
-                                    monitor._formula.verdict,
-                                    monitor.atom_to_observation,
-                                    monitor.atom_to_program_path,
-                                    monitor.collapsing_atom_index,
-                                    monitor.collapsing_atom_sub_index,
-                                    monitor.atom_to_state_dict
-                                )
+                    vypr_output("    New monitor construction finished.")
 
-                    # reset the monitors
-                    maps.static_qd_to_monitors = {}
+            elif len(instantiation_time) == bind_variable_index:
+                vypr_output("    Updating existing monitor timestamp sequence")
+                # extend the monitor's timestamp sequence
+                monitor._monitor_instantiation_time = instantiation_time + (trigger_time,)
 
-                    # send the verdict data
-                    send_verdict_report(
-                        verdict_report,
-                        property_hash,
-                        insertion_data["function_id"],
-                        insertion_data["function_call_id"]
-                    )
+        # add the new monitors
+        static_qd_to_monitors[static_qd_index] += new_monitors
 
-                    # reset the verdict report
-                    maps.verdict_report.reset()
 
-                    # reset the function start time for the next time
-                    maps.latest_time_of_call = None
+def process_path(top_pair, maps):
+    """
+    Process a path recording instrument.
+    """
+    # append the branching condition to the program path encountered so far for this function.
+    maps.program_path.append(top_pair[2])
 
-            elif scope_event == "start":
-                vypr_output("Function '%s' has started." % function_name)
 
-                for property_hash in property_hash_list:
-                    # reset anything that might have been left over from the previous call,
-                    # especially if an unhandled exception caused the function to end without
-                    # vypr instruments sending an end signal
+def process_instrument(top_pair, maps):
+    """
+    Process an instrument that gives an observation for an atom, and update the relevant monitors.
+    """
+    static_qd_to_monitors = maps.static_qd_to_monitors
+    atoms = maps.formula_structure._formula_atoms
+    program_path = maps.program_path
+
+    static_qd_indices = top_pair[2]
+    atom_index = top_pair[3]
+    atom_sub_index = top_pair[4]
+    instrumentation_point_db_ids = top_pair[5]
+    observation_time = top_pair[6]
+    observation_end_time = top_pair[7]
+    observed_value = top_pair[8]
+    thread_id = top_pair[9]
+    try:
+        state_dict = top_pair[10]
+    except:
+        # instrument isn't from a transition measurement
+        state_dict = None
 
-                    maps = verification_obj.function_to_maps[function_name][property_hash]
-                    maps.static_qd_to_monitors = {}
-                    maps.verdict_report.reset()
+    if VYPR_OUTPUT_VERBOSE:
+        vypr_output("Consuming data from an instrument in thread %i", thread_id)
 
-                    # remember when the function call started
-                    maps.latest_time_of_call = top_pair[4]
+    lists = zip(static_qd_indices, instrumentation_point_db_ids)
 
-                vypr_output("Set start time to %s" % maps.latest_time_of_call)
+    for values in lists:
 
-                # reset the program path
-                maps.program_path = []
+        static_qd_index = values[0]
+        instrumentation_point_db_id = values[1]
 
-                vypr_output("*" * 50)
-        else:
+        if VYPR_OUTPUT_VERBOSE:
+            vypr_output("Binding space index : %i", static_qd_index)
+            vypr_output("Atom index : %i", atom_index)
+            vypr_output("Atom sub index : %i", atom_sub_index)
+            vypr_output("Instrumentation point db id : %i", instrumentation_point_db_id)
+            vypr_output("Observation time : %s", observation_time)
+            vypr_output("Observation end time : %s", observation_end_time)
+            vypr_output("Observed value : %s", observed_value)
+            vypr_output("State dictionary : %s", state_dict)
 
-            # we have another kind of instrument that is specific to a property
+        instrumentation_atom = atoms[atom_index]
 
-            property_hash = top_pair[0]
+        # update all monitors associated with static_qd_index
+        if static_qd_to_monitors.get(static_qd_index):
+            for (n, monitor) in enumerate(static_qd_to_monitors[static_qd_index]):
+                # checking for previous observation of the atom is done by the monitor's internal logic
+                monitor.process_atom_and_value(instrumentation_atom, observation_time, observation_end_time,
+                                               observed_value, atom_index, atom_sub_index,
+                                               inst_point_id=instrumentation_point_db_id,
+                                               program_path=len(program_path), state_dict=state_dict)
 
-            # remove the property hash and just deal with the rest of the data
-            top_pair = top_pair[1:]
-            instrument_type = top_pair[0]
-            function_name = top_pair[1]
 
-            # get the maps we need for this function
-            maps = verification_obj.function_to_maps[function_name][property_hash]
-            static_qd_to_monitors = maps.static_qd_to_monitors
-            formula_structure = maps.formula_structure
-            program_path = maps.program_path
+def process_test_status(top_pair, maps):
+    """
+    Send the result of a test to the verdict server.
+    """
+    # verified_function = top_pair[1]
+    status = top_pair[2]
+    start_test_time = top_pair[3]
+    end_test_time = top_pair[4]
+    test_name = top_pair[6]
+
+    # # We are trying to empty all the test cases in order to terminate the monitoring
+    # if test_name in list_test_cases:
+    #     list_test_cases.remove(test_name)
+    #
+    # if len(list_test_cases) == 0:
+    #      continue_monitoring = False
+
+    if status.failures:
+            test_result = "Fail"
+    elif status.errors:
+            test_result = "Error"
+    else:
+            test_result = "Success"
 
-            verdict_report = maps.verdict_report
 
-            atoms = formula_structure._formula_atoms
+    # If test data exists.
+
 
-            if instrument_type == "trigger":
-                # we've received a trigger instrument
+    test_data = {
+     "test_name"   : test_name,
+     "test_result" : test_result,
+     "start_time"  : start_test_time.isoformat(),
+     "end_time"    : end_test_time.isoformat()
 
-                vypr_output("Processing trigger - dealing with monitor instantiation")
+    }
 
-                static_qd_index = top_pair[2]
-                bind_variable_index = top_pair[3]
+    # nothing is done with the response, so it isn't decoded
+    http_session.post(
+        INSERT_TEST_DATA_URL,
+        data=dumps_json(test_data)
+    )
 
-                vypr_output("Trigger is for bind variable %i" % bind_variable_index)
-                if bind_variable_index == 0:
-                    vypr_output("Instantiating new, clean monitor")
-                    # we've encountered a trigger for the first bind variable, so we simply instantiate a new monitor
-                    new_monitor = formula_tree.new_monitor(formula_structure.get_formula_instance())
-                    try:
-                        static_qd_to_monitors[static_qd_index].append(new_monitor)
-                    except:
-                        static_qd_to_monitors[static_qd_index] = [new_monitor]
-                else:
-                    vypr_output("Processing existing monitors")
-                    # we look at the monitors' timestamps, and decide whether to generate a new monitor
-                    # and copy over existing information, or update timestamps of existing monitors
-                    new_monitors = []
-                    subsequences_processed = []
-                    for monitor in static_qd_to_monitors[static_qd_index]:
-                        # check if the monitor's timestamp sequence includes a timestamp for this bind variable
-                        vypr_output(
-                            "  Processing monitor with timestamp sequence %s" % str(monitor._monitor_instantiation_time))
-                        if len(monitor._monitor_instantiation_time) == bind_variable_index + 1:
-                            if monitor._monitor_instantiation_time[:bind_variable_index] in subsequences_processed:
-                                # the same subsequence might have been copied and extended multiple times
-                                # we only care about one
-                                continue
-                            else:
-                                subsequences_processed.append(monitor._monitor_instantiation_time[:bind_variable_index])
-                                # construct new monitor
-                                vypr_output("    Instantiating new monitor with modified timestamp sequence")
-                                # instantiate a new monitor using the timestamp subsequence excluding the current bind
-                                # variable and copy over all observation, path and state information
-
-                                old_instantiation_time = list(monitor._monitor_instantiation_time)
-                                updated_instantiation_time = tuple(
-                                    old_instantiation_time[:bind_variable_index] + [datetime.datetime.now()])
-                                new_monitor = formula_tree.new_monitor(formula_structure.get_formula_instance())
-                                new_monitors.append(new_monitor)
-
-                                # copy timestamp sequence, observation, path and state information
-                                new_monitor._monitor_instantiation_time = updated_instantiation_time
-
-                                # iterate through the observations stored by the previous monitor
-                                # for bind variables before the current one and use them to update the new monitor
-                                for atom_index in monitor._state._state:
-
-                                    atom = atoms[atom_index]
-
-                                    if not (type(atom) is formula_tree.LogicalNot):
-
-                                        # the copy we do for the information related to the atom
-                                        # depends on whether the atom is mixed or not
-
-                                        if formula_tree.is_mixed_atom(atom):
-
-                                            # for mixed atoms, the return value here is a list
-                                            base_variables = get_base_variable(atom)
-                                            # determine the base variables which are before the current bind variable
-                                            relevant_base_variables = filter(
-                                                lambda var : (
-                                                        formula_structure._bind_variables.index(var) < bind_variable_index
-                                                ),
-                                                base_variables
-                                            )
-                                            # determine the base variables' sub-indices in the current atom
-                                            relevant_sub_indices = map(
-                                                lambda var : base_variables.index(var),
-                                                relevant_base_variables
-                                            )
-
-                                            # copy over relevant information for the sub indices
-                                            # whose base variables had positions less than the current variable index
-                                            # relevant_sub_indices can contain at most 0 and 1.
-                                            for sub_index in relevant_sub_indices:
-                                                # set up keys in new monitor state if they aren't already there
-                                                if not(new_monitor.atom_to_observation.get(atom_index)):
-                                                    new_monitor.atom_to_observation[atom_index] = {}
-                                                    new_monitor.atom_to_program_path[atom_index] = {}
-                                                    new_monitor.atom_to_state_dict[atom_index] = {}
-
-                                                # copy over observation, program path and state information
-                                                new_monitor.atom_to_observation[atom_index][sub_index] = \
-                                                    monitor.atom_to_observation[atom_index][sub_index]
-                                                new_monitor.atom_to_program_path[atom_index][sub_index] = \
-                                                    monitor.atom_to_program_path[atom_index][sub_index]
-                                                new_monitor.atom_to_state_dict[atom_index][sub_index] = \
-                                                    monitor.atom_to_state_dict[atom_index][sub_index]
-
-                                            # update the state of the monitor
-                                            new_monitor.check_atom_truth_value(atom, atom_index, atom_sub_index)
-                                        else:
-
-                                            # the atom is not mixed, so copying over information is simpler
-
-                                            if (formula_structure._bind_variables.index(
-                                                    get_base_variable(atom)) < bind_variable_index
-                                                    and not (monitor._state._state[atom] is None)):
-
-                                                # decide how to update the new monitor based on the existing monitor's truth
-                                                # value for it
-                                                if monitor._state._state[atom_index] == True:
-                                                    new_monitor.check_optimised(atom)
-                                                elif monitor._state._state[atom_index] == False:
-                                                    new_monitor.check_optimised(formula_tree.lnot(atom))
-
-                                                # copy over observation, program path and state information
-                                                new_monitor.atom_to_observation[atom_index][0] = \
-                                                    monitor.atom_to_observation[atom_index][0]
-                                                new_monitor.atom_to_program_path[atom_index][0] = \
-                                                    monitor.atom_to_program_path[atom_index][0]
-                                                new_monitor.atom_to_state_dict[atom_index][0] = \
-                                                    monitor.atom_to_state_dict[atom_index][0]
-
-                                vypr_output("    New monitor construction finished.")
-
-                        elif len(monitor._monitor_instantiation_time) == bind_variable_index:
-                            vypr_output("    Updating existing monitor timestamp sequence")
-                            # extend the monitor's timestamp sequence
-                            tmp_sequence = list(monitor._monitor_instantiation_time)
-                            tmp_sequence.append(datetime.datetime.now())
-                            monitor._monitor_instantiation_time = tuple(tmp_sequence)
-
-                    # add the new monitors
-                    static_qd_to_monitors[static_qd_index] += new_monitors
-
-            if instrument_type == "path":
-                # we've received a path recording instrument
-                # append the branching condition to the program path encountered so far for this function.
-                program_path.append(top_pair[2])
-
-            if instrument_type == "instrument":
-
-                static_qd_indices = top_pair[2]
-                atom_index = top_pair[3]
-                atom_sub_index = top_pair[4]
-                instrumentation_point_db_ids = top_pair[5]
-                observation_time = top_pair[6]
-                observation_end_time = top_pair[7]
-                observed_value = top_pair[8]
-                thread_id = top_pair[9]
-                try:
-                    state_dict = top_pair[10]
-                except:
-                    # instrument isn't from a transition measurement
-                    state_dict = None
-
-                vypr_output("Consuming data from an instrument in thread %i" % thread_id)
-
-                lists = zip(static_qd_indices, instrumentation_point_db_ids)
-
-                for values in lists:
-
-                    static_qd_index = values[0]
-                    instrumentation_point_db_id = values[1]
-
-                    vypr_output("Binding space index : %i" % static_qd_index)
-                    vypr_output("Atom index : %i" % atom_index)
-                    vypr_output("Atom sub index : %i" % atom_sub_index)
-                    vypr_output("Instrumentation point db id : %i" % instrumentation_point_db_id)
-                    vypr_output("Observation time : %s" % str(observation_time))
-                    vypr_output("Observation end time : %s" % str(observation_end_time))
-                    vypr_output("Observed value : %s" % observed_value)
-                    vypr_output("State dictionary : %s" % str(state_dict))
-
-                    instrumentation_atom = atoms[atom_index]
-
-                    # update all monitors associated with static_qd_index
-                    if static_qd_to_monitors.get(static_qd_index):
-                        for (n, monitor) in enumerate(static_qd_to_monitors[static_qd_index]):
-                            # checking for previous observation of the atom is done by the monitor's internal logic
-                            monitor.process_atom_and_value(instrumentation_atom, observation_time, observation_end_time,
-                                                           observed_value, atom_index, atom_sub_index,
-                                                           inst_point_id=instrumentation_point_db_id,
-                                                           program_path=len(program_path), state_dict=state_dict)
-
-
-            if instrument_type == "test_status":
-
-
-
-                # verified_function = top_pair[1]
-                status = top_pair[2]
-                start_test_time = top_pair[3]
-                end_test_time = top_pair[4]
-                test_name = top_pair[6]
-
-                # # We are trying to empty all the test cases in order to terminate the monitoring
-                # if test_name in list_test_cases:
-                #     list_test_cases.remove(test_name)
-                #
-                # if len(list_test_cases) == 0:
-                #      continue_monitoring = False
-
-                if status.failures:
-                        test_result = "Fail"
-                elif status.errors:
-                        test_result = "Error"
+
+# map from the type of a property-specific instrument to the function that processes it
+INSTRUMENT_HANDLERS = {
+    "trigger": process_trigger,
+    "path": process_path,
+    "instrument": process_instrument,
+    "test_status": process_test_status
+}
+
+
+def consumption_thread_function(verification_obj):
+    # the web service has to be considered as running forever, so the monitoring loop for now should also run forever
+    # this needs to be changed for a clean exit
+    INACTIVE_MONITORING = False
+    transaction = -1
+    continue_monitoring = True
+    start_sender_threads()
+    consumption_queue = verification_obj.consumption_queue
+    while continue_monitoring:
+
+        # take top element from the queue
+        try:
+            top_pair = consumption_queue.get(timeout=1)
+            ## In case of flask testing
+        except:
+            # Changing flag to false here because in normal testing, end-monitoring does not change to False.
+            # If exception is raised we just terminate the monitoring
+            continue
+
+        # take whatever else has arrived in the meantime, so the events can be processed
+        # together without going back to the queue for each one
+        # instrumented threads put lists of events on the queue, while control events arrive on their own
+        batch = top_pair if type(top_pair) is list else [top_pair]
+        try:
+            while len(batch) < CONSUMPTION_BATCH_SIZE:
+                item = consumption_queue.get_nowait()
+                if type(item) is list:
+                    batch.extend(item)
                 else:
-                        test_result = "Success"
+                    batch.append(item)
+        except Empty:
+            pass
+
+        for top_pair in batch:
+            if top_pair[0] == "end-monitoring":
+                # return from the monitoring function to end the monitoring thread
+                vypr_output("Returning from monitoring thread.")
+                continue_monitoring = False
+                # nothing after the end signal is processed
+                break
+
+            # if monitoring is inactive, we do nothing with what we consume unless it's a resume message
+            if INACTIVE_MONITORING:
+                if top_pair[0] == "inactive-monitoring-stop":
+                    # return from the monitoring function to end the monitoring thread
+                    vypr_output("Restarting monitoring.  Monitoring thread will still be alive.")
+                    INACTIVE_MONITORING = False
+                continue
+            else:
+                if top_pair[0] == "inactive-monitoring-start":
+                    # return from the monitoring function to end the monitoring thread
+                    vypr_output("Pausing monitoring.  Monitoring thread will still be alive.")
+                    # turn on inactive monitoring
+                    INACTIVE_MONITORING = True
+                    # skip to the next iteration of the consumption loop
+                    continue
+            # if inactive monitoring is off (so monitoring is running), process what we consumed
+
+
+            if top_pair[0] == "test_transaction":
+                transaction = top_pair[1]
+                vypr_output("Test Transaction >> %s", top_pair)
+                continue
+
+
+            if VYPR_OUTPUT_VERBOSE:
+                vypr_output("Consuming: %s", top_pair)
 
+            first_element = top_pair[0]
 
-                # If test data exists.
+            if first_element == "function":
 
+                process_function_event(top_pair, verification_obj.function_to_maps, transaction)
+            else:
 
-                test_data = {
-                 "test_name"   : test_name,
-                 "test_result" : test_result,
-                 "start_time"  : start_test_time.isoformat(),
-                 "end_time"    : end_test_time.isoformat()
+                # we have another kind of instrument that is specific to a property
 
-                }
+                property_hash = top_pair[0]
 
-                json.loads(requests.post(
-                    os.path.join(VERDICT_SERVER_URL, "insert_test_data/"),
-                    data=json.dumps(test_data)
-                ).text)
+                # remove the property hash and just deal with the rest of the data
+                top_pair = top_pair[1:]
+                instrument_type = top_pair[0]
+                function_name = top_pair[1]
 
+                # get the maps we need for this function, and hand the instrument to its handler
+                maps = verification_obj.maps_by_function_and_property[(function_name, property_hash)]
+                handler = INSTRUMENT_HANDLERS.get(instrument_type)
+                if not (handler is None):
+                    handler(top_pair, maps)
 
 
-        # set the task as done
-    verification_obj.consumption_queue.task_done()
+
+    # make sure everything has reached the verdict server before the thread ends
+    outbound_queue.join()
 
     vypr_output("Consumption finished.")
 
@@ -566,6 +877,43 @@ def consumption_thread_function(verification_obj):
     #vypr_logger.end_logging()
 
 
+# map from property hash to the index of the property in the specification file
+property_index_cache = {}
+
+
+def fetch_property_indices(property_hashes):
+    """
+    Get the index in the specification file of each property in property_hashes that isn't
+    in property_index_cache yet, and store it there.
+    The verdict server only gives us one property per request, so if there are several properties,
+    the requests are made from a few threads at once rather than one after the other.
+    """
+    unknown_hashes = [property_hash for property_hash in set(property_hashes)
+                      if not (property_hash in property_index_cache)]
+
+    def fetch(hashes):
+        for property_hash in hashes:
+            property_data = loads_json(
+                http_session.get(
+                    GET_PROPERTY_FROM_HASH_URL % property_hash
+                ).text
+            )
+            property_index_cache[property_hash] = property_data["index_in_specification_file"]
+
+    if len(unknown_hashes) <= 1:
+        fetch(unknown_hashes)
+    else:
+        # if a request fails in one of these threads, the property is fetched again
+        # (and the error raised) when its PropertyMapGroup is constructed
+        fetch_threads = [threading.Thread(target=fetch, args=[unknown_hashes[n::SENDER_THREADS]],
+                                          name="vypr-fetch-%i" % n)
+                         for n in range(min(SENDER_THREADS, len(unknown_hashes)))]
+        for fetch_thread in fetch_threads:
+            fetch_thread.start()
+        for fetch_thread in fetch_threads:
+            fetch_thread.join()
+
+
 class PropertyMapGroup(object):
     """
     Groups together all the maps needed for verification of a single run of a single function, wrt a single property.
@@ -576,7 +924,7 @@ class PropertyMapGroup(object):
         self._property_hash = property_hash
 
         # read in binding spaces
-        with open(os.path.join(PROJECT_ROOT, "binding_spaces/module-%s-function-%s-property-%s.dump") % \
+        with open(os.path.join(BINDING_SPACES_DIR, "module-%s-function-%s-property-%s.dump") % \
                   (module_name.replace(".", "-"), function_name.replace(":", "-"), property_hash), "rb") as h:
             binding_space_dump = h.read()
 
@@ -586,20 +934,20 @@ class PropertyMapGroup(object):
             print("Query file generated by instrumentation couldn't be found.  Run VyPR instrumentation first.")
             exit()
 
-        # to get the property structure,
-        property_data = json.loads(
-            requests.get(
-                os.path.join(VERDICT_SERVER_URL, "get_property_from_hash/%s/" % property_hash)
-            ).text
-        )
-        property_index = property_data["index_in_specification_file"]
+        # to get the property structure, we need its index in the specification file
+        fetch_property_indices([property_hash])
+        property_index = property_index_cache[property_hash]
 
         vypr_output("Queries imported.")
 
         # store all the data we have
         self.formula_structure = verification_conf[module_name][function_name.replace(":", ".")][property_index]
+        # work out what the consumption thread needs to know about each atom now, rather than per event
+        for atom_index in range(len(self.formula_structure._formula_atoms)):
+            _atom_meta(self.formula_structure, atom_index)
         self.binding_space = pickle.loads(binding_space_dump)
-        self.static_qd_to_monitors = {}
+        # map from binding space indices to the monitors for them
+        self.static_qd_to_monitors = defaultdict(list)
         self.static_bindings_to_monitor_states = {}
         self.verdict_report = VerdictReport()
         self.latest_time_of_call = None
@@ -607,32 +955,35 @@ class PropertyMapGroup(object):
 
 
 
+# matches whole-line comments in configuration files - either a multi-line comment
+# from a line starting with /* to a line ending with */, or a line starting with # or //
+CONFIGURATION_COMMENT_REGEX = re.compile(r"^[ \t]*/\*.*?\*/[ \t]*$|^[ \t]*(?:#|//)[^\n]*$", re.DOTALL | re.MULTILINE)
+
+
 def read_configuration(file):
     """
     Read in 'file', parse into an object and return.
     """
-    content = ""
-    skip = False
-    for line in open(file):
-        li = line.strip()
+    with open(file) as h:
+        content = h.read()
 
-        # Handle multi-line comments
-        if li.startswith("/*"):
-            skip = True
-        if li.endswith("*/"):
-            skip = False
-            continue
+    return json.loads(CONFIGURATION_COMMENT_REGEX.sub("", content))
 
-        if not (li.startswith("#") or li.startswith("//")) and not skip:
-            content += line
 
-    return json.loads(content)
+# matches the name of a binding space dump file written by instrumentation, capturing
+# the module and function (with dots and colons replaced by dashes) and the property hash
+BINDING_SPACE_DUMP_REGEX = re.compile(
+    r"module-(?P<module>.+?)-function-(?P<function>.+?)-property-(?P<property>[^-]+)\.dump$"
+)
+
+
+# matches the definition of a test function, capturing its name
+TEST_DEFINITION_REGEX = re.compile(r"^\s*def\s+(test\w*)\s*\(", re.MULTILINE)
 
 
 def total_test_cases():
 
     from os.path import dirname, abspath
-    import re
 
     global TEST_DIR
 
@@ -642,8 +993,6 @@ def total_test_cases():
 
     path = ROOT_DIR+'/' + TEST_DIR
 
-    total_tests = []
-
     #for r, d, f in os.walk(os.environ('PATH')):
     for r, d, f in os.walk(path):
 
@@ -651,11 +1000,10 @@ def total_test_cases():
 
             if file.startswith("test_") and (file.endswith('.py') or file.endswith('.py.inst')):
 
-                readfile = open(os.path.join(r, file), "r")
+                # read the whole file and find all test definitions in one pass
+                with open(os.path.join(r, file), "r") as readfile:
+                    test_cases.extend(TEST_DEFINITION_REGEX.findall(readfile.read()))
 
-                for line in readfile:
-                    if re.search('(def)\s(test.*)', line):
-                        test_cases.append( line[5:line.index('(')])
     return test_cases
 
 
@@ -674,13 +1022,20 @@ class Verification(object):
 
         vypr_output("VyPR verification object instantiated...")
 
+        # each instrumented thread keeps its own buffer of events that haven't been put on the consumption queue yet
+        self._thread_local = threading.local()
+
         # read configuration file
         inst_configuration = read_configuration("vypr.config")
-        global VERDICT_SERVER_URL, VYPR_OUTPUT_VERBOSE, PROJECT_ROOT, VYPR_MODULE, TOTAL_TEST_RUN, TEST_FRAMEWORK
+        global VERDICT_SERVER_URL, VYPR_OUTPUT_VERBOSE, PROJECT_ROOT, VYPR_MODULE, TOTAL_TEST_RUN, TEST_FRAMEWORK, \
+            BINDING_SPACES_DIR
         VERDICT_SERVER_URL = inst_configuration.get("verdict_server_url") if inst_configuration.get(
             "verdict_server_url") else "http://localhost:9001/"
-        VYPR_OUTPUT_VERBOSE = inst_configuration.get("verbose") if inst_configuration.get("verbose") else True
+        set_verdict_server_urls(VERDICT_SERVER_URL)
+        # verbose output is on unless it's explicitly turned off
+        VYPR_OUTPUT_VERBOSE = inst_configuration.get("verbose", True)
         PROJECT_ROOT = inst_configuration.get("project_root") if inst_configuration.get("project_root") else ""
+        BINDING_SPACES_DIR = os.path.realpath(os.path.join(PROJECT_ROOT, "binding_spaces"))
         VYPR_MODULE = inst_configuration.get("vypr_module") if inst_configuration.get("vypr_module") else ""
 
         TEST_FRAMEWORK = inst_configuration.get("test") \
@@ -697,11 +1052,16 @@ class Verification(object):
 
         # try to connect to the verdict server before we set anything up
         try:
-            attempt = requests.get(VERDICT_SERVER_URL)
+            attempt = http_session.get(VERDICT_SERVER_URL)
             self.initialisation_failure = False
         except Exception:
-            vypr_output("Couldn't connect to the verdict server at '%s'.  Initialisation failed." % VERDICT_SERVER_URL)
+            vypr_output("Couldn't connect to the verdict server at '%s'.  Initialisation failed.", VERDICT_SERVER_URL)
             self.initialisation_failure = True
+            # instruments and the service can still call these, but there's no monitoring to do
+            self.send_event = lambda event_description: None
+            self.end_monitoring = lambda: None
+            self.pause_monitoring = lambda: None
+            self.resume_monitoring = lambda: None
             return
 
         self.machine_id = ("%s-" % inst_configuration.get("machine_id")) if inst_configuration.get(
@@ -711,60 +1071,75 @@ class Verification(object):
         self.ntp_server = inst_configuration.get("ntp_server")
         if self.ntp_server:
             print("Setting time based on NTP server '%s'." % self.ntp_server)
+            if ntplib is None:
+                vypr_output("An NTP server is given, but ntplib couldn't be imported.")
+                print("An NTP server is given, but ntplib couldn't be imported.")
+                exit()
             # set two timestamps - the local time, and the ntp server time, from the same instant
-            import ntplib
-            client = ntplib.NTPClient()
+            # the client is kept in case the time has to be set again
+            self._ntp_client = ntplib.NTPClient()
             try:
-                response = client.request(self.ntp_server)
-                # set the local start time
+                response = self._ntp_client.request(self.ntp_server)
+                # compute the offset of the ntp server's clock from the local clock using all four timestamps
+                # (request sent, request received by the server, response sent by the server, response received)
+                # - taking the average of the offsets measured on the way there and on the way back
+                # cancels out the network delay, as long as it's the same in both directions
+                self.ntp_offset = ((response.recv_time - response.orig_time) +
+                                   (response.tx_time - response.dest_time)) / 2
+                # the round trip delay, excluding the time the server took to respond
+                self.ntp_round_trip_delay = ((response.dest_time - response.orig_time) -
+                                             (response.tx_time - response.recv_time))
+                vypr_output("NTP offset is %f seconds, with a round trip delay of %f seconds.",
+                            self.ntp_offset, self.ntp_round_trip_delay)
+                # the local and ntp times at the instant the request was sent
                 self.local_start_time = datetime.datetime.utcfromtimestamp(response.orig_time)
-                # compute the delay due to network latency to reach the ntp server
-                adjustment = (response.dest_time - response.orig_time) / 2
-                # set the ntp start time by subtracting the adjustment from the time given by the ntp server
-                # this works because 'adjustment' is approximately the time elapsed
-                # between the first time we measure local time and when the ntp server measures its own time
-                # so by subtracting this difference we adjust the ntp server time to the same instant
-                # as the local time
-                self.ntp_start_time = datetime.datetime.utcfromtimestamp(response.tx_time - adjustment)
+                self.ntp_start_time = datetime.datetime.utcfromtimestamp(response.orig_time + self.ntp_offset)
             except:
-                vypr_output("Couldn't set time based on NTP server '%s'." % self.ntp_server)
+                vypr_output("Couldn't set time based on NTP server '%s'.", self.ntp_server)
                 print("Couldn't set time based on NTP server '%s'." % self.ntp_server)
                 exit()
 
+        vypr_output("Getting time based on %s.", "NTP" if self.ntp_server else "local machine")
+        self.get_time = self.get_ntp_time if self.ntp_server else self.get_local_time
+
         # set up the maps that the monitoring algorithm that the consumption thread runs
 
         # we need the list of functions that we have instrumentation data from, so read the instrumentation maps
         # directory
-        dump_files = filter(lambda filename: ".dump" in filename,
-                            os.listdir(os.path.join(PROJECT_ROOT, "binding_spaces")))
-        functions_and_properties = map(lambda function_dump_file: function_dump_file.replace(".dump", ""),
-                                       dump_files)
-        tokens = map(lambda string: string.split("-"), functions_and_properties)
+        dump_file_matches = []
+        for filename in os.listdir(BINDING_SPACES_DIR):
+            if filename.endswith(".dump"):
+                match = BINDING_SPACE_DUMP_REGEX.search(filename)
+                if match is None:
+                    vypr_output("Ignoring binding space file '%s' with an unexpected name.", filename)
+                else:
+                    dump_file_matches.append(match)
 
-        self.function_to_maps = {}
+        # get the indices of all the properties from the verdict server up front
+        fetch_property_indices([match.group("property") for match in dump_file_matches])
 
-        for token_chain in tokens:
+        self.function_to_maps = {}
+        # the same maps, keyed by (function, property hash) pairs, so the instruments
+        # that belong to a single property can get their maps with one lookup
+        self.maps_by_function_and_property = {}
 
-            start_of_module = token_chain.index("module") + 1
-            start_of_function = token_chain.index("function") + 1
-            start_of_property = token_chain.index("property") + 1
+        machine_id = self.machine_id
+        for match in dump_file_matches:
 
-            module_string = ".".join(token_chain[start_of_module:start_of_function - 1])
+            module_string = match.group("module").replace("-", ".")
             # will need to be modified to support functions that are methods
-            # function = ".".join(token_chain[start_of_function:start_of_property-1])
-            function = ":".join(token_chain[start_of_function:start_of_property - 1])
+            function = match.group("function").replace("-", ":")
 
-            property_hash = token_chain[start_of_property]
+            property_hash = match.group("property")
 
-            vypr_output("Setting up monitoring state for module/function/property triple %s, %s, %s" % (
-                module_string, function, property_hash))
+            vypr_output("Setting up monitoring state for module/function/property triple %s, %s, %s",
+                        module_string, function, property_hash)
 
-            module_function_string = "%s%s.%s" % (self.machine_id, module_string, function)
+            module_function_string = machine_id + module_string + "." + function
 
-            if not (self.function_to_maps.get(module_function_string)):
-                self.function_to_maps[module_function_string] = {}
-            self.function_to_maps[module_function_string][property_hash] = PropertyMapGroup(module_string, function,
-                                                                                            property_hash)
+            maps = PropertyMapGroup(module_string, function, property_hash)
+            self.function_to_maps.setdefault(module_function_string, {})[property_hash] = maps
+            self.maps_by_function_and_property[(module_function_string, property_hash)] = maps
 
         vypr_output(self.function_to_maps)
 
@@ -777,37 +1152,18 @@ class Verification(object):
             # if a VyPR module is given, this means VyPR will be running between requests
 
                 def prepare_vypr():
-                    import datetime
-                    from app import vypr
                     # this function runs inside a request, so flask.g exists
                     # we store just the request time
-                    flask.g.request_time = vypr.get_time()
+                    if request_needs_vypr():
+                        current_flask_g().request_time = self.get_time()
 
                 if flask_object != None:
                     flask_object.before_request(prepare_vypr)
 
                 # add VyPR end points - we may use this for statistics collection on the server
-                # add the safe exist end point
-                @flask_object.route("/vypr/stop-monitoring/")
-                def endpoint_stop_monitoring():
-                    from app import vypr
-                    # send end-monitoring message
-                    vypr.end_monitoring()
-                    # wait for the thread to end
-                    vypr.consumption_thread.join()
-                    return "VyPR monitoring thread exited.  The server must be restarted to turn monitoring back on.\n"
-
-                @flask_object.route("/vypr/pause-monitoring/")
-                def endpoint_pause_monitoring():
-                    from app import vypr
-                    vypr.pause_monitoring()
-                    return "VyPR monitoring paused - thread is still running.\n"
-
-                @flask_object.route("/vypr/resume-monitoring/")
-                def endpoint_resume_monitoring():
-                    from app import vypr
-                    vypr.resume_monitoring()
-                    return "VyPR monitoring resumed.\n"
+                global vypr_instance
+                vypr_instance = self
+                flask_object.register_blueprint(vypr_blueprint, url_prefix="/vypr")
 
 
             # setup consumption queue and store it globally across requests
@@ -816,18 +1172,13 @@ class Verification(object):
         # if no VyPR module is given, this means VyPR will have to run per request
 
             def start_vypr():
-                # setup consumption queue and store it within the request context
-                from flask import g
-                self.consumption_queue = Queue()
-                # setup consumption thread
-                self.consumption_thread = threading.Thread(
-                    target=consumption_thread_function,
-                    args=[self]
-                )
-                # store vypr object in request context
+                # events from every request go to the same consumption queue and thread (set up below),
+                # so we just store the vypr object and the request time in the request context
+                if not request_needs_vypr():
+                    return
+                g = current_flask_g()
                 g.vypr = self
-                self.consumption_thread.start()
-                g.request_time = g.vypr.get_time()
+                g.request_time = self.get_time()
 
             if flask_object != None:
                 flask_object.before_request(start_vypr)
@@ -835,21 +1186,22 @@ class Verification(object):
             # set up tear down function
 
             def stop_vypr(e):
-                # send kill message to consumption thread
-                # for now, we don't wait for the thread to end
-                from flask import g
-                g.vypr.end_monitoring()
+                # the consumption thread is shared between requests, so rather than ending it,
+                # make sure it gets the events this request's thread still has buffered
+                self.flush_events()
 
             if flask_object != None:
                 flask_object.teardown_request(stop_vypr)
 
-        self.consumption_queue = Queue()
-        # setup consumption thread
-        self.consumption_thread = threading.Thread(
-            target=consumption_thread_function,
-            args=[self]
-            )
-        self.consumption_thread.start()
+        # setup consumption queue and thread - one of each, however many times we're initialised
+        if getattr(self, "consumption_thread", None) is None:
+            self.consumption_queue = ConsumptionQueue()
+            self.consumption_thread = threading.Thread(
+                target=consumption_thread_function,
+                args=[self],
+                name="vypr-consumption"
+                )
+            self.consumption_thread.start()
 
         vypr_output("VyPR monitoring initialisation finished.")
 
@@ -859,39 +1211,66 @@ class Verification(object):
         Returns either the machine local time, or the NTP time (using the initial NTP time
         obtained when VyPR started up, so we don't query an NTP server everytime we want to measure time).
         The result is in UTC.
+        Once __init__ knows whether there's an NTP server, it replaces this with get_ntp_time or get_local_time,
+        so instruments don't decide which to use every time they measure time.
         :return: datetime.datetime object
         """
         if self.ntp_server:
-            vypr_output("Getting time based on NTP.")
-            current_local_time = datetime.datetime.utcnow()
-            # compute the time elapsed since the start
-            difference = current_local_time - self.local_start_time
-            # add that time to the ntp time obtained at the start
-            current_ntp_time = self.ntp_start_time + difference
-            return current_ntp_time
+            return self.get_ntp_time(callee)
         else:
-            vypr_output("Getting time based on local machine - %s" % callee)
-            return datetime.datetime.utcnow()
+            return self.get_local_time(callee)
+
+    def get_ntp_time(self, callee=""):
+        # the ntp time obtained at the start plus the time elapsed since is the current local time
+        # plus the difference between the two clocks at the start
+        return datetime.datetime.utcfromtimestamp(time.time() + self.ntp_offset)
+
+    def get_local_time(self, callee=""):
+        return datetime.datetime.utcnow()
 
     def send_event(self, event_description):
-        if not (self.initialisation_failure):
-            self.consumption_queue.put(event_description)
+        """
+        Events from triggers, paths and instruments are kept in a buffer for the current thread and put on the
+        consumption queue together (as a list), either when the buffer is full or when the thread sends any other
+        event, such as the end of a function call.  So the consumer still sees each thread's events in order.
+        If initialisation failed, this is replaced by a function that does nothing.
+        """
+        try:
+            event_buffer = self._thread_local.event_buffer
+        except AttributeError:
+            event_buffer = self._thread_local.event_buffer = []
+        event_buffer.append(event_description)
+        if (len(event_buffer) >= EVENT_BUFFER_SIZE
+                or not (len(event_description) > 1 and event_description[1] in BUFFERED_INSTRUMENT_TYPES)):
+            self.consumption_queue.put(event_buffer)
+            self._thread_local.event_buffer = []
+
+    def flush_events(self):
+        """
+        Put any events buffered by the current thread on the consumption queue.
+        """
+        event_buffer = getattr(self._thread_local, "event_buffer", None)
+        if event_buffer:
+            self.consumption_queue.put(event_buffer)
+            self._thread_local.event_buffer = []
+
+    # like send_event, these three are replaced by functions that do nothing if initialisation failed
 
     def end_monitoring(self):
-        if not (self.initialisation_failure):
-            print ("End monitoring signal")
-            vypr_output("Ending VyPR monitoring thread.")
-            self.consumption_queue.put(("end-monitoring",))
+        print ("End monitoring signal")
+        vypr_output("Ending VyPR monitoring thread.")
+        self.flush_events()
+        self.consumption_queue.put(("end-monitoring",))
 
     def pause_monitoring(self):
-        if not (self.initialisation_failure):
-            vypr_output("Sending monitoring pause message.")
-            self.consumption_queue.put(("inactive-monitoring-start",))
+        vypr_output("Sending monitoring pause message.")
+        self.flush_events()
+        self.consumption_queue.put(("inactive-monitoring-start",))
 
     def resume_monitoring(self):
-        if not (self.initialisation_failure):
-            vypr_output("Sending monitoring resume message.")
-            self.consumption_queue.put(("inactive-monitoring-stop",))
+        vypr_output("Sending monitoring resume message.")
+        self.flush_events()
+        self.consumption_queue.put(("inactive-monitoring-stop",))
 
     def get_test_result_in_flask(self,className, methodName, result):
         print("Got the name and the status of the test {} {} {}".format(className, methodName, result))
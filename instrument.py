@@ -12,6 +12,7 @@ import requests
 import argparse
 import os
 import json
+import re
 import base64
 import datetime
 import py_compile
@@ -288,17 +289,19 @@ def compute_binding_space(quantifier_sequence, scfg, reachability_map, current_b
     if len(current_binding) == 0:
         # we've just started - compute the static qd for the first quantifier,
         # then iterate over it and recurse into the list of quantifiers for each element
-        if type(list(quantifier_sequence._bind_variables)[0]) is StaticState:
-            if list(quantifier_sequence._bind_variables)[0]._name_changed:
+        # the first quantifier is inspected several times, so the list of variables is only built once
+        first_bind_variable = list(quantifier_sequence._bind_variables)[0]
+        if type(first_bind_variable) is StaticState:
+            if first_bind_variable._name_changed:
                 # a name was given as selection criteria
-                variable_changed = list(quantifier_sequence._bind_variables)[0]._name_changed
+                variable_changed = first_bind_variable._name_changed
                 qd = list(filter(lambda symbolic_state: symbolic_state._name_changed == variable_changed \
                                                         or variable_changed in symbolic_state._name_changed,
                                  scfg.vertices))
                 # we also check loop variables
                 # when instruments are placed, if a loop vertex is processed instrumentation will change accordingly
                 for vertex in scfg.vertices:
-                    if vertex._name_changed == ["loop"]:
+                    if vertex._name_changed is LOOP_MARKER:
                         if (type(vertex._structure_obj.target) is ast.Name and
                                 vertex._structure_obj.target.id == variable_changed):
                             # the variable we're looking for was found as a simple loop variable
@@ -310,10 +313,10 @@ def compute_binding_space(quantifier_sequence, scfg, reachability_map, current_b
             else:
                 qd = []
                 # a list of coordinates were given
-                if type(list(quantifier_sequence._bind_variables)[0]._instruction_coordinates) is list:
-                    coordinates = list(quantifier_sequence._bind_variables)[0]._instruction_coordinates
+                if type(first_bind_variable._instruction_coordinates) is list:
+                    coordinates = first_bind_variable._instruction_coordinates
                 else:
-                    coordinates = [list(quantifier_sequence._bind_variables)[0]._instruction_coordinates]
+                    coordinates = [first_bind_variable._instruction_coordinates]
                 for coordinate in coordinates:
                     # get all vertices whose previous edges have statements with matching lineno values,
                     # sort the col_offset values in ascending order, then get the vertex at the index
@@ -336,8 +339,8 @@ def compute_binding_space(quantifier_sequence, scfg, reachability_map, current_b
                     relevant_vertices.sort(key=lambda vertex: vertex._previous_edge._instruction.col_offset)
                     relevant_vertex = relevant_vertices[offset]
                     qd.append(relevant_vertex)
-        elif type(list(quantifier_sequence._bind_variables)[0]) is StaticTransition:
-            variable_operated_on = list(quantifier_sequence._bind_variables)[0]._operates_on
+        elif type(first_bind_variable) is StaticTransition:
+            variable_operated_on = first_bind_variable._operates_on
             relevant_target_vertices = list(filter(
                 lambda symbolic_state: symbolic_state._name_changed == variable_operated_on \
                                        or variable_operated_on in symbolic_state._name_changed,
@@ -478,26 +481,19 @@ def is_verdict_server_reachable():
         return False
 
 
+# matches whole-line comments in configuration files - either a multi-line comment
+# from a line starting with /* to a line ending with */, or a line starting with # or //
+CONFIGURATION_COMMENT_REGEX = re.compile(r"^[ \t]*/\*.*?\*/[ \t]*$|^[ \t]*(?:#|//)[^\n]*$", re.DOTALL | re.MULTILINE)
+
+
 def read_configuration(file):
     """
     Read in 'file', parse into an object and return.
     """
-    content = ""
-    skip = False
-    for line in open(file):
-        li = line.strip()
-
-        # Handle multi-line comments
-        if li.startswith("/*"):
-            skip = True
-        if li.endswith("*/"):
-            skip = False
-            continue
-
-        if not (li.startswith("#") or li.startswith("//")) and not skip:
-            content += line
+    with open(file) as h:
+        content = h.read()
 
-    return json.loads(content)
+    return json.loads(CONFIGURATION_COMMENT_REGEX.sub("", content))
 
 
 
@@ -519,9 +515,9 @@ def get_instrumentation_points_from_comp_sequence(value_from_binding, moves):
         if type(move) is NextStaticTransition:
             calls = []
             if type(value_from_binding) is CFGVertex:
-                scfg.next_calls(value_from_binding, move._operates_on, calls, marked_vertices=[])
+                calls = scfg.next_calls(value_from_binding, move._operates_on)
             elif type(value_from_binding) is CFGEdge:
-                scfg.next_calls(value_from_binding._target_state, move._operates_on, calls, marked_vertices=[])
+                calls = scfg.next_calls(value_from_binding._target_state, move._operates_on)
             instrumentation_points = calls
         elif type(move) in [SourceStaticState, DestinationStaticState]:
             # we don't need to do anything with these yet
@@ -621,7 +617,7 @@ def instrument_point_state(state, name, point, binding_space_indices,
 
     else:
 
-        if point._name_changed == ["loop"]:
+        if point._name_changed is LOOP_MARKER:
             # we're instrumenting the change of a loop variable
             logger.log("Performing instrumentation for loop variable.")
             # determine the edge leading into the loop body
@@ -1534,7 +1530,7 @@ if __name__ == "__main__":
                     line_numbers = []
                     for el in element:
                         if type(el) is CFGVertex:
-                            if el._name_changed != ["loop"]:
+                            if el._name_changed is not LOOP_MARKER:
                                 line_numbers.append(el._previous_edge._instruction.lineno)
                             else:
                                 line_numbers.append(el._structure_obj.lineno)
@@ -1633,7 +1629,7 @@ if __name__ == "__main__":
 
                         instrument_ast = ast.parse(instrument).body[0]
                         if type(point) is CFGVertex:
-                            if point._name_changed == ["loop"]:
+                            if point._name_changed is LOOP_MARKER:
                                 # triggers for loop variables must be inserted inside the loop
                                 # so we instantiate a new monitor for every iteration
                                 for edge in point.edges:
@@ -1673,7 +1669,7 @@ if __name__ == "__main__":
                                 atom_index_in_db = atom_index_to_db_index[atom_index]
                                 # for now, we don't need serialised_condition_sequence so we just use a blank string
                                 if type(point) is CFGVertex:
-                                    if point._name_changed == ["loop"]:
+                                    if point._name_changed is LOOP_MARKER:
                                         # find edge leading into loop body and use the path length for the destination
                                         # state
                                         for edge in point.edges:
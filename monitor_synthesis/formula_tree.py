@@ -1199,21 +1199,17 @@ class Checker(object):
         Given an atom and a value, update this monitor.
         """
         # record the observation, path and state
-        # we have to use lists to be able to capture  multiple observations required for mixed atoms
-        if not (self.atom_to_observation.get(atom_index)):
-            self.atom_to_observation[atom_index] = {}
-            self.atom_to_program_path[atom_index] = {}
-            self.atom_to_state_dict[atom_index] = {}
-
-        if not (self.atom_to_observation[atom_index].get(atom_sub_index)):
-            self.atom_to_observation[atom_index][atom_sub_index] =\
-                (value, inst_point_id, observation_time, observation_end_time)
-            self.atom_to_program_path[atom_index][atom_sub_index] = program_path
-            self.atom_to_state_dict[atom_index][atom_sub_index] = state_dict
-        else:
+        # we have to use maps from sub-indices to be able to capture multiple observations required for mixed atoms
+        # (these maps are sent to the verdict server as they are, so they stay dicts rather than lists)
+        observations = self.atom_to_observation.setdefault(atom_index, {})
+        if atom_sub_index in observations:
             # the observation has already been processed - no need to do anything
             return
 
+        observations[atom_sub_index] = (value, inst_point_id, observation_time, observation_end_time)
+        self.atom_to_program_path.setdefault(atom_index, {})[atom_sub_index] = program_path
+        self.atom_to_state_dict.setdefault(atom_index, {})[atom_sub_index] = state_dict
+
         # check the truth value of the relevant atom based on the state that we've built up so far
         result = self.check_atom_truth_value(atom, atom_index, atom_sub_index)
 